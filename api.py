@@ -1,18 +1,37 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header
+from fastapi.responses import JSONResponse, StreamingResponse, Response, PlainTextResponse
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.openapi.utils import get_openapi
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+from datetime import datetime
+import asyncio
+import importlib.util
+import itertools
 import json
 import tempfile
 import os
+import re
 from pydantic import BaseModel
 import shutil
+from contextlib import asynccontextmanager
+from starlette.concurrency import run_in_threadpool
+from starlette.formparsers import MultiPartParser
 from openai_requests import send_request, send_request_vision
-import uvicorn
-from db import insert_batch_request, get_queued_requests, update_requests_to_processing, initialize_database
+from db import insert_batch_request, get_queued_requests, update_requests_to_processing, initialize_database, iter_request_results
 from blob import upload_multiple_files, create_container
-from documentIntelligence import process_document_to_markdown
+from documentIntelligence import process_upload_to_markdown
+from text_layer import route_document, shutdown_process_pool
+from profiling import add_profiling
+from bulk import ingest_archive, ingest_manifest
+from coalesce import hash_file, compute_fingerprint
+from export import export_results, FORMATS
+from schema_registry import resolve_schema, register_schema, get_schema, SchemaNotFoundError
+from prewarm import start_prewarm
+from retention import start_retention
+from scheduler import render_queue_metrics
+from status_feed import load_status, get_fresh, feed, refresh_watched
+from webhooks import check_callback_url, start_webhooks, stop_webhooks
+import config
 
 # Define response models for better documentation
 class ProcessingResponse(BaseModel):
@@ -24,18 +43,145 @@ class ErrorResponse(BaseModel):
     """Error response model"""
     detail: str
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Heavy SDKs are imported lazily; optionally warm them and their connections in the background
+    start_prewarm()
+    # Keeps long-polled statuses fresh when another process updates them
+    refresh_task = asyncio.create_task(refresh_watched())
+    # Optional background archiving of finished requests and their blobs
+    retention_stop = start_retention()
+    # Sends webhook callbacks for requests this process finishes, and sweeps pending ones
+    start_webhooks()
+    yield
+    refresh_task.cancel()
+    if retention_stop:
+        retention_stop.set()
+    # Waits for deliveries in progress; callbacks not yet sent stay pending in the database
+    await run_in_threadpool(stop_webhooks)
+    # Text layer worker processes, started on first use
+    await run_in_threadpool(shutdown_process_pool)
+
 app = FastAPI(
     title="Document Processing API", 
     description="API for processing documents using Azure OpenAI services",
     version="1.0.0",
     docs_url="/docs",  # Default Swagger UI endpoint
-    redoc_url="/redoc"  # Alternative documentation UI
+    redoc_url="/redoc",  # Alternative documentation UI
+    lifespan=lifespan
 )
 
+# Opt-in per-request profiling (see profiling.py); a no-op unless configured
+add_profiling(app)
+
 # Create a temporary directory to store uploaded files
 TEMP_DIR = os.path.join(tempfile.gettempdir(), "document_processing")
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Multipart uploads are kept in memory up to this size and spill to an anonymous temporary file above it.
+# This is a class attribute, so it applies process-wide: every multipart endpoint of this app, including
+# /queue_documents/bulk archives and manifests, and any other Starlette app loaded in the same process.
+if hasattr(MultiPartParser, "spool_max_size"):
+    MultiPartParser.spool_max_size = config.get_int("UPLOAD_SPOOL_MAX_BYTES", 4 * 1024 * 1024)
+
+def check_upload_sizes(files):
+    """
+    Reject uploads above MAX_UPLOAD_BYTES per file or MAX_REQUEST_UPLOAD_BYTES for all files of the request.
+    The synchronous endpoints can hold every file of a request in memory at once (the vision path keeps a
+    base64 copy of each), so the total is what bounds their peak memory per request.
+    """
+    max_bytes = config.get_int("MAX_UPLOAD_BYTES", 50 * 1024 * 1024)
+    max_total_bytes = config.get_int("MAX_REQUEST_UPLOAD_BYTES", 100 * 1024 * 1024)
+    total = 0
+    for file in files:
+        size = file.size
+        if size is None:
+            size = file.file.seek(0, os.SEEK_END)
+            file.file.seek(0)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"File {file.filename} is larger than {max_bytes} bytes")
+        total += size
+        if total > max_total_bytes:
+            raise HTTPException(status_code=413, detail=f"Files of the request are larger than {max_total_bytes} bytes in total")
+
+def resolve_request_schema(schema, schema_id):
+    """Resolve the inline or registered schema of a request, mapping failures to HTTP errors"""
+    try:
+        return resolve_schema(schema_text=schema, schema_id=schema_id)
+    except SchemaNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Schema {schema_id} not found")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def validate_callback_url(callback_url):
+    """Reject callback urls the server may not call; host names are resolved and checked again at delivery"""
+    if callback_url:
+        try:
+            check_callback_url(callback_url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def validate_tenant_id(tenant_id):
+    """Reject tenant ids that do not fit the TenantId column or would need escaping in metrics labels"""
+    if not re.fullmatch(r"[A-Za-z0-9._-]{1,100}", tenant_id):
+        raise HTTPException(status_code=400, detail="tenant_id must be 1-100 letters, digits, '.', '_' or '-'")
+
+def parse_model_response(response, compiled_schema):
+    """Parse the model output and reject it if it does not match the compiled schema"""
+    if not (hasattr(response, 'choices') and response.choices):
+        return JSONResponse(content={
+            "response": str(response)
+        })
+
+    try:
+        result = json.loads(response.choices[0].message.content)
+    except (TypeError, json.JSONDecodeError):
+        raise HTTPException(status_code=502, detail="Model output is not valid JSON")
+
+    errors = compiled_schema.validate(result)
+    if errors:
+        raise HTTPException(status_code=502, detail=f"Model output does not match schema: {'; '.join(errors[:10])}")
+    return JSONResponse(content=result)
+
+@app.post(
+    "/schemas",
+    summary="Register a response schema",
+    description="Register a JSON schema once and reference it by the returned schema_id in later requests",
+    response_model=Dict[str, Any],
+    responses={
+        400: {"description": "Bad request", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse}
+    }
+)
+async def create_schema(
+    schema: str = Form(..., description="JSON schema for structured output")
+):
+    try:
+        compiled_schema = register_schema(schema)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error registering schema: {str(e)}")
+
+    return JSONResponse(content={"schema_id": compiled_schema.id})
+
+@app.get(
+    "/schemas/{schema_id}",
+    summary="Get a registered response schema",
+    description="Return the JSON schema registered under schema_id",
+    response_model=Dict[str, Any],
+    responses={
+        404: {"description": "Schema not found", "model": ErrorResponse}
+    }
+)
+async def read_schema(schema_id: str):
+    try:
+        compiled_schema = get_schema(schema_id)
+    except SchemaNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Schema {schema_id} not found")
+
+    return JSONResponse(content=compiled_schema.schema)
+
 @app.post(
     "/process_document", 
     summary="Process documents with Azure OpenAI",
@@ -51,56 +197,53 @@ async def process_document(
     files: List[UploadFile] = File(..., description="Documents to process"),
     deployment_name: str = Form(..., description="Azure OpenAI model deployment name"),
     instructions: str = Form(..., description="Instructions for processing the documents"),
-    schema: str = Form(..., description="JSON schema for structured output")
+    schema: Optional[str] = Form(None, description="JSON schema for structured output"),
+    schema_id: Optional[str] = Form(None, description="Id of a schema registered with POST /schemas, instead of schema")
 ):
     # Validate inputs
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
     
-    try:
-        # Parse the JSON schema
-        json_schema = json.loads(schema)
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON schema")
+    # Parsed and compiled once per process, then served from cache
+    compiled_schema = resolve_request_schema(schema, schema_id)
     
-    # Save uploaded files temporarily
-    temp_file_paths = []
+    # Uploads stay in their spooled buffers (see UPLOAD_SPOOL_MAX_BYTES), nothing is copied to TEMP_DIR
+    check_upload_sizes(files)
     try:
-        for file in files:
-            file_path = os.path.join(TEMP_DIR, file.filename)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            temp_file_paths.append(file_path)
-        
-        # conver files into markdown
+        # conver files into markdown, from the PDF text layer where it is good enough when the fast path is on
         markdown = ""
-        for file_path in temp_file_paths:
-            markdown += process_document_to_markdown(file_path) + "\n\n"
+        routing = []
+        for file in files:
+            if config.get_bool("TEXT_LAYER_FAST_PATH"):
+                file.file.seek(0)
+                # Waits on the process pool (and Document Intelligence for mixed documents), so keep it off the event loop
+                text, report = await run_in_threadpool(route_document, file.filename, file.file.read())
+                routing.append(report)
+                markdown += text + "\n\n"
+            else:
+                # Document Intelligence calls block, so they run in the thread pool like the fast path
+                markdown += await run_in_threadpool(process_upload_to_markdown, file.file) + "\n\n"
 
-        # Process the documents
-        response = send_request(
+        # Process the documents; the model call blocks too, so it runs in the thread pool
+        response = await run_in_threadpool(
+            send_request,
             markdown=markdown,
             instructions=instructions,
             model_deployment_name=deployment_name,
-            structuredOutputJson=json_schema
+            structuredOutputJson=compiled_schema.schema
         )
         
-        # Parse the response
-        if hasattr(response, 'choices') and response.choices:
-            result = json.loads(response.choices[0].message.content)
-            return JSONResponse(content=result)
-        else:
-            return JSONResponse(content={
-                "response": str(response)
-            })
+        # Parse the response and check it against the schema
+        json_response = parse_model_response(response, compiled_schema)
+        if routing:
+            # Which conversion path each file took, and how long it took
+            json_response.headers["X-Document-Routing"] = json.dumps(routing)
+        return json_response
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing documents: {str(e)}")
-    finally:
-        # Clean up temporary files
-        for file_path in temp_file_paths:
-            if os.path.exists(file_path):
-                os.remove(file_path)
 
 @app.post(
     "/process_document_vision", 
@@ -117,52 +260,35 @@ async def process_document_vision(
     files: List[UploadFile] = File(..., description="Documents to process"),
     deployment_name: str = Form(..., description="Azure OpenAI model deployment name"),
     instructions: str = Form(..., description="Instructions for processing the documents"),
-    schema: str = Form(..., description="JSON schema for structured output")
+    schema: Optional[str] = Form(None, description="JSON schema for structured output"),
+    schema_id: Optional[str] = Form(None, description="Id of a schema registered with POST /schemas, instead of schema")
 ):
     # Validate inputs
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
     
-    try:
-        # Parse the JSON schema
-        json_schema = json.loads(schema)
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON schema")
+    # Parsed and compiled once per process, then served from cache
+    compiled_schema = resolve_request_schema(schema, schema_id)
     
-    # Save uploaded files temporarily
-    temp_file_paths = []
+    # Uploads stay in their spooled buffers and are base64 encoded straight from them
+    check_upload_sizes(files)
     try:
-        for file in files:
-            file_path = os.path.join(TEMP_DIR, file.filename)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            temp_file_paths.append(file_path)
-    
-
-        # Process the documents
-        response = send_request_vision(
-            files=temp_file_paths,
+        # Process the documents; encoding the files and the model call block, so they run in the thread pool
+        response = await run_in_threadpool(
+            send_request_vision,
+            files=[(file.filename, file.file) for file in files],
             instructions=instructions,
             model_deployment_name=deployment_name,
-            structuredOutputJson=json_schema
+            structuredOutputJson=compiled_schema.schema
         )
         
-        # Parse the response
-        if hasattr(response, 'choices') and response.choices:
-            result = json.loads(response.choices[0].message.content)
-            return JSONResponse(content=result)
-        else:
-            return JSONResponse(content={
-                "response": str(response)
-            })
+        # Parse the response and check it against the schema
+        return parse_model_response(response, compiled_schema)
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing documents: {str(e)}")
-    finally:
-        # Clean up temporary files
-        for file_path in temp_file_paths:
-            if os.path.exists(file_path):
-                os.remove(file_path)
 
 
 @app.post(
@@ -180,17 +306,19 @@ async def process_document(
     files: List[UploadFile] = File(..., description="Documents to process"),
     deployment_name: str = Form(..., description="Azure OpenAI model deployment name"),
     instructions: str = Form(..., description="Instructions for processing the documents"),
-    schema: str = Form(..., description="JSON schema for structured output")
+    schema: Optional[str] = Form(None, description="JSON schema for structured output"),
+    schema_id: Optional[str] = Form(None, description="Id of a schema registered with POST /schemas, instead of schema"),
+    callback_url: Optional[str] = Form(None, description="URL to POST the status and result to when the request finishes"),
+    tenant_id: str = Form("default", description="Tenant the request belongs to, for fair scheduling of the batch queue")
 ):
     # Validate inputs
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
     
-    try:
-        # Parse the JSON schema
-        json_schema = json.loads(schema)
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON schema")
+    # Parsed and compiled once per process, then served from cache
+    compiled_schema = resolve_request_schema(schema, schema_id)
+    validate_callback_url(callback_url)
+    validate_tenant_id(tenant_id)
     
     # Save uploaded files temporarily
     temp_file_paths = []
@@ -205,6 +333,15 @@ async def process_document(
                 shutil.copyfileobj(file.file, buffer)
             temp_file_paths.append(file_path)
 
+        # Identical requests (same content, instructions, schema and deployment) share a fingerprint
+        # and are sent to the model only once
+        fingerprint = compute_fingerprint(
+            [hash_file(file_path) for file_path in temp_file_paths],
+            instructions,
+            compiled_schema.id,
+            deployment_name
+        )
+
         # Upload files to blob storage
         blob_url_dict = upload_multiple_files(container_name, temp_file_paths)
 
@@ -216,8 +353,12 @@ async def process_document(
         request_id = insert_batch_request(
             model_deployment_name=deployment_name,
             instructions=instructions,
-            response_json_schema=json_schema,
-            file_names=",".join(blob_url_dict.values())
+            response_json_schema=compiled_schema.text,
+            file_names=",".join(blob_url_dict.values()),
+            schema_id=compiled_schema.id,
+            callback_url=callback_url,
+            fingerprint=fingerprint,
+            tenant_id=tenant_id
         )
 
         return JSONResponse(content={
@@ -225,6 +366,8 @@ async def process_document(
             "request_id": request_id
         })
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing documents: {str(e)}")
     finally:
@@ -233,6 +376,161 @@ async def process_document(
             if os.path.exists(file_path):
                 os.remove(file_path)
 
+@app.post(
+    "/queue_documents/bulk",
+    summary="Queue many documents for batch processing in one call",
+    description="Upload a zip archive of documents, or an NDJSON manifest of blob URLs, to queue one request per document. "
+                "Form fields are defaults; per-document deployment_name, instructions, schema_id, schema or callback_url can be given in the "
+                "manifest lines (or in a manifest.ndjson entry of the archive, keyed by \"file\").",
+    response_model=Dict[str, Any],
+    responses={
+        200: {"description": "Successfully queued documents"},
+        400: {"description": "Bad request", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse}
+    }
+)
+async def queue_documents_bulk(
+    archive: Optional[UploadFile] = File(None, description="Zip archive of documents to queue"),
+    manifest: Optional[UploadFile] = File(None, description="NDJSON manifest, one {\"url\": ...} object per document"),
+    deployment_name: Optional[str] = Form(None, description="Default Azure OpenAI model deployment name"),
+    instructions: Optional[str] = Form(None, description="Default instructions for processing the documents"),
+    schema: Optional[str] = Form(None, description="Default JSON schema for structured output"),
+    schema_id: Optional[str] = Form(None, description="Id of a registered default schema, instead of schema"),
+    callback_url: Optional[str] = Form(None, description="Default URL to POST each request's status and result to when it finishes"),
+    tenant_id: str = Form("default", description="Tenant all requests of the job belong to, for fair scheduling of the batch queue")
+):
+    # Validate inputs
+    if (archive is None) == (manifest is None):
+        raise HTTPException(status_code=400, detail="Provide exactly one of archive or manifest")
+
+    defaults = {
+        "deployment_name": deployment_name,
+        "instructions": instructions,
+        "schema": resolve_request_schema(schema, schema_id) if (schema or schema_id) else None,
+        "callback_url": callback_url,
+        "tenant_id": tenant_id,
+    }
+    validate_callback_url(callback_url)
+    validate_tenant_id(tenant_id)
+
+    try:
+        # Uploads and inserts block, so keep them off the event loop
+        if archive is not None:
+            job = await run_in_threadpool(ingest_archive, archive.file, defaults)
+        else:
+            job = await run_in_threadpool(ingest_manifest, manifest.file, defaults)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error queueing documents: {str(e)}")
+
+    return JSONResponse(content={
+        "message": "Documents queued for processing",
+        **job
+    })
+
+@app.get(
+    "/requests/{request_id}",
+    summary="Get the status of a queued request",
+    description="Return the status of a queued request with an ETag. Send If-None-Match with the last ETag and wait=<seconds> "
+                "to long-poll: the call returns as soon as the status changes, or 304 Not Modified when the wait expires",
+    response_model=Dict[str, Any],
+    responses={
+        304: {"description": "Status unchanged"},
+        404: {"description": "Request not found", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse}
+    }
+)
+async def get_request_status(
+    request_id: str,
+    wait: float = 0,
+    if_none_match: Optional[str] = Header(None)
+):
+    try:
+        # Served from the in-memory change feed while it is fresh; the database is read otherwise
+        snapshot = get_fresh(request_id) or await run_in_threadpool(load_status, request_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading request status: {str(e)}")
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail=f"Request {request_id} not found")
+
+    if if_none_match and if_none_match == snapshot["etag"] and wait > 0:
+        timeout = min(wait, config.get_float("LONG_POLL_MAX_SECONDS", 60.0))
+        snapshot = await feed.wait_for_change(request_id, if_none_match, timeout) or snapshot
+
+    headers = {"ETag": snapshot["etag"], "Cache-Control": "no-cache"}
+    if if_none_match == snapshot["etag"]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content={
+        "request_id": snapshot["request_id"],
+        "status": snapshot["status"],
+        "batch_id": snapshot["batch_id"]
+    }, headers=headers)
+
+@app.get(
+    "/results/export",
+    summary="Export request results",
+    description="Stream the status and result of every request of a bulk job, a creation time range and/or a list of request ids, "
+                "as NDJSON (default) or Parquet, optionally gzip compressed",
+    responses={
+        200: {"description": "Streamed export", "content": {"application/x-ndjson": {}, "application/vnd.apache.parquet": {}}},
+        400: {"description": "Bad request", "model": ErrorResponse},
+        500: {"description": "Server error", "model": ErrorResponse}
+    }
+)
+async def export_request_results(
+    job_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    ids: Optional[str] = None,
+    format: str = "ndjson",
+    compression: Optional[str] = None,
+    page_size: int = 1000
+):
+    # Validate inputs
+    id_list = [i.strip() for i in ids.split(",") if i.strip()] if ids else None
+    if not (job_id or since or until or id_list):
+        raise HTTPException(status_code=400, detail="Provide job_id, since, until or ids")
+    if id_list and len(id_list) > 2000:
+        raise HTTPException(status_code=400, detail="At most 2000 ids can be exported per call")
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(FORMATS)}")
+    if format == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise HTTPException(status_code=400, detail="Parquet export requires the pyarrow package")
+    if compression not in (None, "gzip"):
+        raise HTTPException(status_code=400, detail="compression must be gzip or omitted")
+    if not 1 <= page_size <= 10000:
+        raise HTTPException(status_code=400, detail="page_size must be between 1 and 10000")
+
+    pages = iter_request_results(job_id=job_id, since=since, until=until, ids=id_list, page_size=page_size)
+    try:
+        # Fetch the first page before responding so query errors still produce a proper status code
+        first_page = await run_in_threadpool(next, pages, None)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error exporting results: {str(e)}")
+    if first_page is not None:
+        pages = itertools.chain([first_page], pages)
+
+    media_type, extension = FORMATS[format]
+    headers = {"Content-Disposition": f"attachment; filename=results.{extension}{'.gz' if compression else ''}"}
+    if compression == "gzip":
+        media_type = "application/gzip"
+    # Sync iterators are consumed in a worker thread, page by page, as the client reads
+    return StreamingResponse(export_results(pages, format, compression), media_type=media_type, headers=headers)
+
+@app.get(
+    "/metrics",
+    summary="Batch queue metrics",
+    description="Per-tenant queue depth and age of the oldest request, in the Prometheus text format",
+    response_class=PlainTextResponse
+)
+async def queue_metrics():
+    try:
+        metrics = await run_in_threadpool(render_queue_metrics)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reading queue metrics: {str(e)}")
+    return PlainTextResponse(metrics, media_type="text/plain; version=0.0.4")
+
 @app.get(
     "/",
     summary="API Status",
@@ -265,6 +563,7 @@ def custom_openapi():
 app.openapi = custom_openapi
 
 if __name__ == "__main__":
+    import uvicorn
     #initialize_database() # Ensure the database is initialized
     #create_container("document-processing")  # Ensure the blob container exists
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
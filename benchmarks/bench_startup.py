@@ -0,0 +1,72 @@
+# Measures cold start cost: import time of the api module and time to the first served request.
+# Each measurement runs in a fresh interpreter so nothing is cached between runs.
+#
+# Usage: python benchmarks/bench_startup.py [--runs 5]
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports the app and serves GET / in-process; prints timings as JSON
+PROBE = """
+import json, time
+start = time.perf_counter()
+import api
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(api.app)
+client_ready = time.perf_counter()
+client.get("/")
+first_request = time.perf_counter()
+print(json.dumps({
+    "import_api_ms": (imported - start) * 1000,
+    "first_request_ms": (first_request - client_ready) * 1000,
+    "import_to_first_response_ms": (first_request - start) * 1000 - (client_ready - imported) * 1000,
+}))
+"""
+
+# Cost of the SDKs that api.py used to import eagerly, for comparison
+SDK_PROBE = """
+import json, time
+timings = {}
+for name in ["openai", "azure.storage.blob", "azure.ai.formrecognizer", "pyodbc"]:
+    start = time.perf_counter()
+    try:
+        __import__(name)
+        timings[name + "_ms"] = (time.perf_counter() - start) * 1000
+    except ImportError:
+        timings[name + "_ms"] = None
+print(json.dumps(timings))
+"""
+
+def run_probe(code):
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def summarize(samples):
+    summary = {}
+    for key in samples[0]:
+        values = [s[key] for s in samples if s[key] is not None]
+        summary[key] = round(statistics.median(values), 1) if values else None
+    return summary
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark API cold start")
+    parser.add_argument("--runs", type=int, default=5, help="Number of fresh interpreters per measurement")
+    args = parser.parse_args()
+
+    app_samples = [run_probe(PROBE) for _ in range(args.runs)]
+    sdk_samples = [run_probe(SDK_PROBE) for _ in range(args.runs)]
+
+    print("Median over", args.runs, "runs (ms)")
+    for name, value in summarize(app_samples).items():
+        print(f"  {name:32} {value}")
+    print("SDK import cost deferred to first use (ms)")
+    for name, value in summarize(sdk_samples).items():
+        print(f"  {name:32} {value}")
@@ -1,19 +1,18 @@
 import os
 import logging
-from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
-from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from functools import lru_cache
+import config  # loads .env once per process
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
+@lru_cache(maxsize=None)
 def get_blob_service_client():
     """
     Create a blob service client using connection string from environment variables.
+    The client is created on first use (importing the storage SDK only then) and shared afterwards
+    so that its HTTP connection pool is reused across requests.
     
     Returns:
         BlobServiceClient: The blob service client for Azure operations
@@ -22,6 +21,8 @@ def get_blob_service_client():
     if not connection_string:
         raise ValueError("STORAGE_CONNECTION_STRING environment variable not set")
     
+    from azure.storage.blob import BlobServiceClient
+
     try:
         blob_service_client = BlobServiceClient.from_connection_string(connection_string)
         return blob_service_client
@@ -39,6 +40,8 @@ def create_container(container_name):
     Returns:
         ContainerClient: The container client for the created container
     """
+    from azure.core.exceptions import ResourceExistsError
+
     blob_service_client = get_blob_service_client()
     try:
         container_client = blob_service_client.create_container(container_name)
@@ -51,6 +54,26 @@ def create_container(container_name):
         logger.error(f"Error creating container {container_name}: {str(e)}")
         raise
 
+@lru_cache(maxsize=None)
+def ensure_container(container_name):
+    """
+    Make sure a container exists, checking only once per process.
+    
+    Args:
+        container_name (str): Name of the container
+        
+    Returns:
+        ContainerClient: The container client
+    """
+    blob_service_client = get_blob_service_client()
+    try:
+        container_client = blob_service_client.get_container_client(container_name)
+        if not container_client.exists():
+            container_client = create_container(container_name)
+    except Exception:
+        container_client = create_container(container_name)
+    return container_client
+
 def upload_file(container_name, file_path, blob_name=None):
     """
     Upload a file to Azure Blob Storage.
@@ -70,12 +93,7 @@ def upload_file(container_name, file_path, blob_name=None):
     blob_service_client = get_blob_service_client()
     
     # Ensure container exists
-    try:
-        container_client = blob_service_client.get_container_client(container_name)
-        if not container_client.exists():
-            container_client = create_container(container_name)
-    except Exception:
-        container_client = create_container(container_name)
+    ensure_container(container_name)
     
     # Upload file
     try:
@@ -92,6 +110,28 @@ def upload_file(container_name, file_path, blob_name=None):
         logger.error(f"Error uploading file {file_path}: {str(e)}")
         raise
 
+def upload_stream(container_name, blob_name, data, length=None):
+    """
+    Upload a stream or bytes to Azure Blob Storage without staging it on disk.
+    
+    Args:
+        container_name (str): Name of the container
+        blob_name (str): Name to give the blob in storage
+        data (bytes or file-like): Content to upload, read in chunks by the SDK
+        length (int, optional): Number of bytes to upload, if known
+        
+    Returns:
+        str: URL of the uploaded blob
+    """
+    container_client = ensure_container(container_name)
+    try:
+        blob_client = container_client.upload_blob(blob_name, data, length=length, overwrite=True)
+        logger.info(f"Stream uploaded to {container_name}/{blob_name}")
+        return blob_client.url
+    except Exception as e:
+        logger.error(f"Error uploading {blob_name}: {str(e)}")
+        raise
+
 def upload_multiple_files(container_name, file_paths):
     """
     Upload multiple files to Azure Blob Storage.
@@ -126,6 +166,8 @@ def download_file(container_name, blob_name, download_path):
     Returns:
         str: Path to the downloaded file
     """
+    from azure.core.exceptions import ResourceNotFoundError
+
     blob_service_client = get_blob_service_client()
     
     try:
@@ -159,6 +201,8 @@ def list_blobs(container_name, name_starts_with=None):
     Returns:
         list: List of blob names in the container
     """
+    from azure.core.exceptions import ResourceNotFoundError
+
     blob_service_client = get_blob_service_client()
     
     try:
@@ -184,6 +228,8 @@ def delete_blob(container_name, blob_name):
     Returns:
         bool: True if deletion was successful, False otherwise
     """
+    from azure.core.exceptions import ResourceNotFoundError
+
     blob_service_client = get_blob_service_client()
     
     try:
@@ -200,6 +246,42 @@ def delete_blob(container_name, blob_name):
         logger.error(f"Error deleting blob {blob_name}: {str(e)}")
         raise
 
+def delete_blobs(container_name, blob_urls, if_unmodified_since=None, batch_size=256):
+    """
+    Delete blobs in bulk using batch requests (up to 256 deletes per round trip).
+    URLs that do not point into this container are ignored, so blobs owned elsewhere are never deleted.
+    
+    Args:
+        container_name (str): Name of the container
+        blob_urls (list): URLs of the blobs to delete
+        if_unmodified_since (datetime, optional): Only delete blobs not modified since this time
+        batch_size (int): Number of deletes per batch request
+        
+    Returns:
+        int: Number of blobs deleted
+    """
+    from urllib.parse import unquote
+    
+    container_client = get_blob_service_client().get_container_client(container_name)
+    prefix = container_client.url.rstrip("/") + "/"
+    blob_names = sorted({unquote(url[len(prefix):].split("?")[0]) for url in blob_urls if url and url.startswith(prefix)})
+    
+    deleted = 0
+    for start in range(0, len(blob_names), batch_size):
+        chunk = blob_names[start:start + batch_size]
+        try:
+            # raise_on_any_failure=False: missing or recently modified blobs are skipped, not fatal
+            responses = container_client.delete_blobs(
+                *chunk, if_unmodified_since=if_unmodified_since, raise_on_any_failure=False
+            )
+            deleted += sum(1 for response in responses if response.status_code == 202)
+        except Exception as e:
+            logger.error(f"Error deleting blobs from container {container_name}: {str(e)}")
+            raise
+    
+    logger.info(f"Deleted {deleted} of {len(blob_names)} blobs from container {container_name}")
+    return deleted
+
 def get_blob_sas_url(container_name, blob_name, expiry_hours=1):
     """
     Generate a Shared Access Signature (SAS) URL for a blob with read permissions.
@@ -0,0 +1,183 @@
+# Bulk ingestion of documents into the batch queue, from a zip archive or an NDJSON manifest of blob URLs.
+# Entries are uploaded concurrently and all rows of a job are inserted in one batched transaction.
+import os
+import json
+import uuid
+import logging
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+import config
+from blob import upload_stream
+from db import insert_batch_requests
+from schema_registry import resolve_schema, SchemaNotFoundError
+from coalesce import HashingReader, compute_fingerprint
+from webhooks import check_callback_url
+
+logger = logging.getLogger(__name__)
+
+CONTAINER_NAME = "document-processing"
+# Optional entry of a zip archive holding per-document overrides, one JSON object per line with a "file" key
+ARCHIVE_MANIFEST_NAME = "manifest.ndjson"
+
+def _build_row(defaults, overrides, file_names, where):
+    """
+    Merge per-document overrides over the job defaults into a BatchRequest row.
+
+    Args:
+        defaults (dict): deployment_name, instructions, compiled schema and callback_url of the job (values may be None)
+        overrides (dict): Per-document deployment_name, instructions, schema_id, schema or callback_url
+        file_names (str): Comma separated blob URLs of the document
+        where (str): Location of the document in the input, used in error messages
+
+    Returns:
+        dict: Row for insert_batch_requests
+
+    Raises:
+        ValueError: If a required setting is missing or invalid
+    """
+    deployment_name = overrides.get("deployment_name") or defaults["deployment_name"]
+    instructions = overrides.get("instructions") or defaults["instructions"]
+    callback_url = overrides.get("callback_url") or defaults.get("callback_url")
+    if callback_url:
+        try:
+            check_callback_url(callback_url)
+        except ValueError as e:
+            raise ValueError(f"{where}: {str(e)}")
+    if "schema_id" in overrides or "schema" in overrides:
+        schema = overrides.get("schema")
+        if isinstance(schema, dict):
+            schema = json.dumps(schema)
+        try:
+            compiled_schema = resolve_schema(schema_text=schema, schema_id=overrides.get("schema_id"))
+        except SchemaNotFoundError:
+            raise ValueError(f"{where}: schema {overrides.get('schema_id')} not found")
+        except ValueError as e:
+            raise ValueError(f"{where}: {str(e)}")
+    else:
+        compiled_schema = defaults["schema"]
+
+    if not deployment_name or not instructions or compiled_schema is None:
+        raise ValueError(f"{where}: deployment_name, instructions and a schema are required")
+
+    return {
+        "model_deployment_name": deployment_name,
+        "instructions": instructions,
+        "response_json_schema": compiled_schema.text,
+        "schema_id": compiled_schema.id,
+        "file_names": file_names,
+        "callback_url": callback_url,
+    }
+
+def _set_fingerprint(row, content_hashes):
+    row["fingerprint"] = compute_fingerprint(content_hashes, row["instructions"], row["schema_id"], row["model_deployment_name"])
+
+def _read_overrides(lines):
+    """
+    Parse NDJSON override lines, skipping blank ones.
+
+    Args:
+        lines (iterable): Lines of the manifest (str or bytes)
+
+    Yields:
+        tuple: (line number, parsed object)
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON ({str(e)})")
+        if not isinstance(entry, dict):
+            raise ValueError(f"Line {line_number}: expected a JSON object")
+        yield line_number, entry
+
+def ingest_manifest(manifest_file, defaults):
+    """
+    Queue one request per line of an NDJSON manifest of already uploaded blobs.
+    Each line has "url" (or "urls", a list) plus optional deployment_name, instructions, schema_id, schema or callback_url.
+
+    Args:
+        manifest_file (file-like): Binary NDJSON stream, read line by line
+        defaults (dict): Job defaults, see _build_row, plus the tenant_id the whole job belongs to
+
+    Returns:
+        dict: job_id and the number of queued requests
+    """
+    job_id = str(uuid.uuid4())
+    rows = []
+    for line_number, entry in _read_overrides(manifest_file):
+        urls = entry.get("urls") or ([entry["url"]] if entry.get("url") else [])
+        if not urls or not all(isinstance(u, str) and u.startswith(("https://", "http://")) for u in urls):
+            raise ValueError(f"Line {line_number}: 'url' or 'urls' must contain http(s) URLs")
+        row = _build_row(defaults, entry, ",".join(urls), f"Line {line_number}")
+        # The content is not read here, so blobs are identified by URL for coalescing
+        _set_fingerprint(row, urls)
+        rows.append(row)
+
+    if not rows:
+        raise ValueError("Manifest is empty")
+
+    insert_batch_requests(rows, job_id, tenant_id=defaults.get("tenant_id") or "default")
+    logger.info(f"Queued bulk job {job_id} with {len(rows)} requests from manifest")
+    return {"job_id": job_id, "count": len(rows)}
+
+def ingest_archive(archive_file, defaults):
+    """
+    Queue one request per file of a zip archive. Entries are streamed out of the archive straight
+    into blob storage by a pool of BULK_UPLOAD_CONCURRENCY workers, then all rows are inserted at once.
+    An optional manifest.ndjson entry gives per-file overrides as {"file": <entry name>, ...}.
+
+    Args:
+        archive_file (file-like): Seekable binary stream of the zip archive
+        defaults (dict): Job defaults, see _build_row, plus the tenant_id the whole job belongs to
+
+    Returns:
+        dict: job_id and the number of queued requests
+    """
+    job_id = str(uuid.uuid4())
+    try:
+        archive = zipfile.ZipFile(archive_file)
+    except zipfile.BadZipFile:
+        raise ValueError("Archive is not a valid zip file")
+
+    with archive:
+        entries = [
+            info for info in archive.infolist()
+            if not info.is_dir() and info.filename != ARCHIVE_MANIFEST_NAME
+            and not os.path.basename(info.filename).startswith(".")
+        ]
+        if not entries:
+            raise ValueError("Archive contains no documents")
+
+        overrides = {}
+        if ARCHIVE_MANIFEST_NAME in archive.namelist():
+            with archive.open(ARCHIVE_MANIFEST_NAME) as manifest:
+                for line_number, entry in _read_overrides(manifest):
+                    overrides[entry.get("file")] = entry
+
+        # Validate every row before uploading anything
+        rows = [
+            _build_row(defaults, overrides.get(info.filename, {}), None, info.filename)
+            for info in entries
+        ]
+
+        def upload_entry(index, info):
+            blob_name = f"{job_id}/{index}-{os.path.basename(info.filename)}"
+            # ZipFile serialises reads of the shared archive, so entries can be opened from several threads
+            with archive.open(info) as data:
+                # Hash the content as it streams past, for coalescing of identical requests
+                reader = HashingReader(data)
+                url = upload_stream(CONTAINER_NAME, blob_name, reader, length=info.file_size)
+                return url, reader.hexdigest()
+
+        with ThreadPoolExecutor(max_workers=config.get_int("BULK_UPLOAD_CONCURRENCY", 16)) as executor:
+            uploads = list(executor.map(upload_entry, range(len(entries)), entries))
+
+    for row, (url, content_hash) in zip(rows, uploads):
+        row["file_names"] = url
+        _set_fingerprint(row, [content_hash])
+
+    insert_batch_requests(rows, job_id, tenant_id=defaults.get("tenant_id") or "default")
+    logger.info(f"Queued bulk job {job_id} with {len(rows)} requests from archive")
+    return {"job_id": job_id, "count": len(rows)}
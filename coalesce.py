@@ -0,0 +1,76 @@
+# Coalescing of identical queued requests. A request's fingerprint covers the content of its documents,
+# its instructions, its schema and its deployment; requests sharing a fingerprint are sent to the model
+# once, as one batch line, and the single result is copied to every one of them.
+import hashlib
+from collections import OrderedDict
+
+class HashingReader:
+    """
+    File-like wrapper that computes the SHA-256 of everything read through it,
+    so content can be hashed while it is being uploaded.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+def hash_file(file_path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 of a file, reading it in chunks.
+
+    Args:
+        file_path (str): Path to the file
+
+    Returns:
+        str: Hex digest
+    """
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def compute_fingerprint(content_hashes, instructions, schema_id, model_deployment_name):
+    """
+    Fingerprint a request. Documents are identified by their content hash, so the same file uploaded
+    twice under different blob names still matches; their order is kept, as it is part of the prompt.
+
+    Args:
+        content_hashes (list): Content hash of each document, in request order
+        instructions (str): Instructions of the request
+        schema_id (str): Registry id (SHA-256 of the canonical JSON) of the response schema
+        model_deployment_name (str): Deployment the request targets
+
+    Returns:
+        str: Hex SHA-256 fingerprint
+    """
+    fingerprint = hashlib.sha256()
+    for part in (model_deployment_name, schema_id, instructions, *content_hashes):
+        encoded = (part or "").encode("utf-8")
+        # Length-prefix each part so different splits of the same bytes cannot collide
+        fingerprint.update(len(encoded).to_bytes(8, "big"))
+        fingerprint.update(encoded)
+    return fingerprint.hexdigest()
+
+def coalesce_requests(requests_list):
+    """
+    Group queued requests that share a fingerprint. Rows without one (queued before fingerprints
+    existed) are kept on their own under their id.
+
+    Args:
+        requests_list (list): BatchRequest rows as dicts
+
+    Returns:
+        OrderedDict: custom_id (fingerprint or request id) -> list of rows, in first-seen order
+    """
+    groups = OrderedDict()
+    for req in requests_list:
+        groups.setdefault(req.get("Fingerprint") or req["Id"], []).append(req)
+    return groups
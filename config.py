@@ -0,0 +1,34 @@
+# Process-wide configuration. The .env file is read once, the first time this module is imported,
+# and every other module reads settings from os.environ through the helpers below.
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def get_setting(name, default=None):
+    """
+    Read a string setting.
+
+    Args:
+        name (str): Environment variable name
+        default (str, optional): Value returned when the variable is unset or empty
+
+    Returns:
+        str: The setting value
+    """
+    value = os.environ.get(name)
+    return value if value else default
+
+def get_int(name, default):
+    value = get_setting(name)
+    return int(value) if value is not None else default
+
+def get_float(name, default):
+    value = get_setting(name)
+    return float(value) if value is not None else default
+
+def get_bool(name, default=False):
+    value = get_setting(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
@@ -1,15 +1,34 @@
 # Handles file uploads, SQL Database, and batch logic for the HTTP trigger
 import logging
 import os
+import json
 import uuid
-import pyodbc
-from datetime import datetime
-from dotenv import load_dotenv
+from datetime import datetime, timedelta
+import config  # loads .env once per process
 
-load_dotenv()
+# Statuses a request does not leave; reaching one sets its Completed time
+FINAL_STATUSES = ("completed", "failed")
 
-# Helper to get SQL connection
+# Callables notified with a list of status changes after they are committed.
+# Each change is a dict with Id, Status, BatchId, Result and CallbackUrl.
+_status_listeners = []
+
+def add_status_listener(listener):
+    _status_listeners.append(listener)
+
+def _notify_status_listeners(changes):
+    for listener in _status_listeners:
+        try:
+            listener(changes)
+        except Exception as e:
+            logging.error(f"Error in status listener: {str(e)}")
+
+# Helper to get SQL connection. pyodbc is imported on first use so that importing this
+# module does not load the ODBC driver manager. Connections are only reused if pooling is enabled
+# in the driver manager (unixODBC: Pooling = Yes in odbcinst.ini); otherwise each call logs in.
 def get_sql_connection():
+    import pyodbc
+
     server = os.environ.get("SQL_SERVER")
     database = os.environ.get("SQL_DATABASE")
     username = os.environ.get("SQL_USERNAME")
@@ -39,6 +58,124 @@ def initialize_database():
                 Created DATETIME NOT NULL
             )
         END
+
+        IF COL_LENGTH('BatchRequest', 'SchemaId') IS NULL
+            ALTER TABLE BatchRequest ADD SchemaId NVARCHAR(64)
+
+        IF COL_LENGTH('BatchRequest', 'JobId') IS NULL
+            ALTER TABLE BatchRequest ADD JobId NVARCHAR(50)
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequest_JobId')
+            CREATE INDEX IX_BatchRequest_JobId ON BatchRequest (JobId)
+
+        IF COL_LENGTH('BatchRequest', 'CallbackUrl') IS NULL
+            ALTER TABLE BatchRequest ADD CallbackUrl NVARCHAR(2048)
+
+        IF COL_LENGTH('BatchRequest', 'Fingerprint') IS NULL
+            ALTER TABLE BatchRequest ADD Fingerprint NVARCHAR(64)
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequest_BatchId_Fingerprint')
+            CREATE INDEX IX_BatchRequest_BatchId_Fingerprint ON BatchRequest (BatchId, Fingerprint)
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequest_Status_Created')
+            CREATE INDEX IX_BatchRequest_Status_Created ON BatchRequest (Status, Created)
+
+        IF COL_LENGTH('BatchRequest', 'TenantId') IS NULL
+            ALTER TABLE BatchRequest ADD TenantId NVARCHAR(100) NOT NULL
+                CONSTRAINT DF_BatchRequest_TenantId DEFAULT 'default' WITH VALUES
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequest_Status_TenantId_Created')
+            CREATE INDEX IX_BatchRequest_Status_TenantId_Created ON BatchRequest (Status, TenantId, Created)
+
+        -- When a dispatcher claimed the request ('dispatching'), so abandoned claims can be requeued
+        IF COL_LENGTH('BatchRequest', 'Claimed') IS NULL
+            ALTER TABLE BatchRequest ADD Claimed DATETIME
+
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'BatchRequestArchive')
+        BEGIN
+            CREATE TABLE BatchRequestArchive (
+                Id NVARCHAR(50) PRIMARY KEY,
+                ModelDeploymentName NVARCHAR(100) NOT NULL,
+                ResponseJsonSchema NVARCHAR(MAX) NOT NULL,
+                Instructions NVARCHAR(MAX) NOT NULL,
+                Status NVARCHAR(50) NOT NULL,
+                FileNames NVARCHAR(MAX) NOT NULL,
+                BatchId NVARCHAR(50),
+                Result NVARCHAR(MAX),
+                Created DATETIME NOT NULL,
+                SchemaId NVARCHAR(64),
+                JobId NVARCHAR(50),
+                CallbackUrl NVARCHAR(2048),
+                Fingerprint NVARCHAR(64),
+                Archived DATETIME NOT NULL
+            )
+            CREATE INDEX IX_BatchRequestArchive_Archived ON BatchRequestArchive (Archived)
+        END
+
+        IF COL_LENGTH('BatchRequestArchive', 'TenantId') IS NULL
+            ALTER TABLE BatchRequestArchive ADD TenantId NVARCHAR(100)
+
+        -- Status and export reads fall back to the archive, by id (the primary key), job or creation time
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequestArchive_JobId')
+            CREATE INDEX IX_BatchRequestArchive_JobId ON BatchRequestArchive (JobId)
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequestArchive_Created')
+            CREATE INDEX IX_BatchRequestArchive_Created ON BatchRequestArchive (Created)
+
+        -- Completion time, which retention measures age from. Requests that finished before the column
+        -- existed count as finished now, so none is archived earlier than RETENTION_DAYS after this upgrade.
+        IF COL_LENGTH('BatchRequest', 'Completed') IS NULL
+        BEGIN
+            ALTER TABLE BatchRequest ADD Completed DATETIME
+            EXEC('UPDATE BatchRequest SET Completed = GETDATE() WHERE Status IN (''completed'', ''failed'')')
+        END
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequest_Status_Completed')
+            CREATE INDEX IX_BatchRequest_Status_Completed ON BatchRequest (Status, Completed)
+
+        IF COL_LENGTH('BatchRequestArchive', 'Completed') IS NULL
+            ALTER TABLE BatchRequestArchive ADD Completed DATETIME
+
+        -- Webhook callbacks not yet delivered, so they survive a restart. CallbackNextAttempt is when the
+        -- next attempt is due; until then no sweeper picks the row up.
+        IF COL_LENGTH('BatchRequest', 'CallbackPending') IS NULL
+            ALTER TABLE BatchRequest ADD CallbackPending BIT NOT NULL
+                CONSTRAINT DF_BatchRequest_CallbackPending DEFAULT 0
+
+        IF COL_LENGTH('BatchRequest', 'CallbackAttempts') IS NULL
+            ALTER TABLE BatchRequest ADD CallbackAttempts INT NOT NULL
+                CONSTRAINT DF_BatchRequest_CallbackAttempts DEFAULT 0
+
+        IF COL_LENGTH('BatchRequest', 'CallbackNextAttempt') IS NULL
+            ALTER TABLE BatchRequest ADD CallbackNextAttempt DATETIME
+
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_BatchRequest_CallbackPending')
+            CREATE INDEX IX_BatchRequest_CallbackPending ON BatchRequest (CallbackNextAttempt) WHERE CallbackPending = 1
+
+        -- One row per blob URL a request references, so retention can tell whether a blob is still in use
+        -- with an index seek instead of searching every FileNames list
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'BatchRequestBlob')
+        BEGIN
+            CREATE TABLE BatchRequestBlob (
+                RequestId NVARCHAR(50) NOT NULL,
+                BlobUrl NVARCHAR(MAX) NOT NULL,
+                BlobUrlHash AS CAST(HASHBYTES('SHA2_256', BlobUrl) AS BINARY(32)) PERSISTED
+            )
+            CREATE INDEX IX_BatchRequestBlob_RequestId ON BatchRequestBlob (RequestId)
+            CREATE INDEX IX_BatchRequestBlob_BlobUrlHash ON BatchRequestBlob (BlobUrlHash)
+            EXEC('INSERT INTO BatchRequestBlob (RequestId, BlobUrl)
+                  SELECT r.Id, s.value FROM BatchRequest r CROSS APPLY STRING_SPLIT(r.FileNames, '','') s
+                  WHERE LEN(s.value) > 0')
+        END
+
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'ResponseSchema')
+        BEGIN
+            CREATE TABLE ResponseSchema (
+                Id NVARCHAR(64) PRIMARY KEY,
+                SchemaJson NVARCHAR(MAX) NOT NULL,
+                Created DATETIME NOT NULL
+            )
+        END
         """)
         conn.commit()
     except Exception as e:
@@ -47,17 +184,26 @@ def initialize_database():
         cursor.close()
         conn.close()
 
-# Insert a new batch request
-def insert_batch_request(model_deployment_name, response_json_schema, instructions, file_names):
+# Rows for BatchRequestBlob: the request id with each blob URL of a comma separated FileNames value
+def _blob_references(id, file_names):
+    return [(id, url) for url in (file_names or "").split(",") if url]
+
+# Insert a new batch request. The schema is stored as JSON text; schema_id references the schema registry.
+def insert_batch_request(model_deployment_name, response_json_schema, instructions, file_names, schema_id=None, callback_url=None, fingerprint=None, tenant_id="default"):
     conn = get_sql_connection()
     cursor = conn.cursor()
     id = str(uuid.uuid4())
+    if not isinstance(response_json_schema, str):
+        response_json_schema = json.dumps(response_json_schema)
     
     try:
         cursor.execute("""
-        INSERT INTO BatchRequest (Id, ModelDeploymentName, ResponseJsonSchema, Instructions, Status, FileNames, Created)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (id, model_deployment_name, str(response_json_schema), instructions, "queued", file_names, datetime.now()))
+        INSERT INTO BatchRequest (Id, ModelDeploymentName, ResponseJsonSchema, Instructions, Status, FileNames, Created, SchemaId, CallbackUrl, Fingerprint, TenantId)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (id, model_deployment_name, response_json_schema, instructions, "queued", file_names, datetime.now(), schema_id, callback_url, fingerprint, tenant_id))
+        cursor.executemany("""
+        INSERT INTO BatchRequestBlob (RequestId, BlobUrl) VALUES (?, ?)
+        """, _blob_references(id, file_names))
         conn.commit()
     finally:
         cursor.close()
@@ -65,17 +211,74 @@ def insert_batch_request(model_deployment_name, response_json_schema, instructio
     
     return id
 
-# Get queued requests for a model
-def get_queued_requests():
+# Insert many batch requests belonging to one bulk job, in chunks with fast_executemany.
+# Each row is a dict with model_deployment_name, response_json_schema, instructions, file_names, schema_id,
+# callback_url and fingerprint.
+def insert_batch_requests(rows, job_id, tenant_id="default", chunk_size=1000):
+    if not rows:
+        return []
+        
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    cursor.fast_executemany = True
+    ids = [str(uuid.uuid4()) for _ in rows]
+    created = datetime.now()
+    
+    try:
+        for start in range(0, len(rows), chunk_size):
+            params = [
+                (id, row["model_deployment_name"], row["response_json_schema"], row["instructions"], "queued",
+                 row["file_names"], created, row.get("schema_id"), job_id, row.get("callback_url"), row.get("fingerprint"), tenant_id)
+                for id, row in zip(ids[start:start + chunk_size], rows[start:start + chunk_size])
+            ]
+            cursor.executemany("""
+            INSERT INTO BatchRequest (Id, ModelDeploymentName, ResponseJsonSchema, Instructions, Status, FileNames, Created, SchemaId, JobId, CallbackUrl, Fingerprint, TenantId)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, params)
+            cursor.executemany("""
+            INSERT INTO BatchRequestBlob (RequestId, BlobUrl) VALUES (?, ?)
+            """, [
+                reference
+                for id, row in zip(ids[start:start + chunk_size], rows[start:start + chunk_size])
+                for reference in _blob_references(id, row["file_names"])
+            ])
+        # One transaction for the whole job, so a failure leaves no partial job behind
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return ids
+
+# Get queued requests, oldest first. Rows being claimed by another dispatcher are skipped (READPAST).
+# With per_tenant_limit, only the oldest per_tenant_limit rows of each tenant are read: the distinct
+# tenants come from the keys of the (Status, TenantId, Created) index and each tenant's rows from a
+# TOP seek on it, so a tenant's huge backlog is never read in full to pick a fair batch.
+def get_queued_requests(per_tenant_limit=None):
     conn = get_sql_connection()
     cursor = conn.cursor()
     results = []
     
     try:
-        cursor.execute("""
-        SELECT * FROM BatchRequest 
-        WHERE Status = 'queued'
-        """)
+        if per_tenant_limit:
+            cursor.execute("""
+            SELECT queued.* FROM (
+                SELECT DISTINCT TenantId FROM BatchRequest WITH (READPAST)
+                WHERE Status = 'queued'
+            ) AS tenants
+            CROSS APPLY (
+                SELECT TOP (?) * FROM BatchRequest WITH (READPAST)
+                WHERE Status = 'queued' AND TenantId = tenants.TenantId
+                ORDER BY Created, Id
+            ) AS queued
+            ORDER BY queued.Created, queued.Id
+            """, (per_tenant_limit,))
+        else:
+            cursor.execute("""
+            SELECT * FROM BatchRequest WITH (READPAST)
+            WHERE Status = 'queued'
+            ORDER BY Created, Id
+            """)
         
         columns = [column[0] for column in cursor.description]
         for row in cursor.fetchall():
@@ -116,6 +319,76 @@ def update_requests_to_processing(ids, batch_id):
     finally:
         cursor.close()
         conn.close()
+    
+    _notify_status_listeners([
+        {"Id": id, "Status": "processing", "BatchId": batch_id, "Result": None, "CallbackUrl": None} for id in ids
+    ])
+
+# Claim queued requests for dispatch by moving them to 'dispatching', and return the ids that were
+# claimed. Only rows still queued are taken and rows locked by a concurrent claim are skipped, so when
+# several dispatchers pick the same rows each row is claimed, and submitted, by exactly one of them.
+def claim_queued_requests(ids):
+    if not ids:
+        return []
+        
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        placeholders = ','.join(['?' for _ in ids])
+        cursor.execute(f"""
+        UPDATE BatchRequest WITH (UPDLOCK, READPAST)
+        SET Status = 'dispatching', Claimed = ?
+        OUTPUT inserted.Id
+        WHERE Id IN ({placeholders}) AND Status = 'queued'
+        """, [datetime.now()] + ids)
+        claimed = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return claimed
+
+# Put claimed requests back in the queue, either because their dispatch failed (ids) or because the
+# claim was abandoned, e.g. by a crashed dispatcher (claimed_before). Returns how many were requeued.
+def release_claimed_requests(ids=None, claimed_before=None):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        if ids:
+            placeholders = ','.join(['?' for _ in ids])
+            cursor.execute(f"""
+            UPDATE BatchRequest
+            SET Status = 'queued', Claimed = NULL
+            WHERE Id IN ({placeholders}) AND Status = 'dispatching'
+            """, ids)
+        else:
+            cursor.execute("""
+            UPDATE BatchRequest
+            SET Status = 'queued', Claimed = NULL
+            WHERE Status = 'dispatching' AND Claimed < ?
+            """, (claimed_before,))
+        released = cursor.rowcount
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return released
+
+# Reaching a final status with a CallbackUrl leaves a pending callback. The process that made the
+# change tries it at once, so the sweeper leaves it alone for WEBHOOK_LEASE_SECONDS.
+CALLBACK_PENDING_UPDATE = """
+    CallbackPending = CASE WHEN CallbackUrl IS NOT NULL AND ? IS NOT NULL THEN 1 ELSE 0 END,
+    CallbackAttempts = 0, CallbackNextAttempt = ?
+"""
+
+def _callback_pending_params(completed):
+    if completed is None:
+        return (None, None)
+    return (completed, completed + timedelta(seconds=config.get_float("WEBHOOK_LEASE_SECONDS", 300)))
 
 # Update status and result
 def update_request_status(id, status, result=None):
@@ -123,18 +396,356 @@ def update_request_status(id, status, result=None):
     cursor = conn.cursor()
     
     try:
+        # OUTPUT returns the row as updated, so listeners get the batch id and callback url without another query
+        # Completed is when the request reached a final status; retention measures age from it
+        completed = datetime.now() if status in FINAL_STATUSES else None
         if result:
-            cursor.execute("""
+            cursor.execute(f"""
             UPDATE BatchRequest
-            SET Status = ?, Result = ?
+            SET Status = ?, Result = ?, Completed = ?, {CALLBACK_PENDING_UPDATE}
+            OUTPUT inserted.BatchId, inserted.CallbackUrl
             WHERE Id = ?
-            """, (status, result, id))
+            """, (status, result, completed, *_callback_pending_params(completed), id))
         else:
-            cursor.execute("""
+            cursor.execute(f"""
             UPDATE BatchRequest
-            SET Status = ?
+            SET Status = ?, Completed = ?, {CALLBACK_PENDING_UPDATE}
+            OUTPUT inserted.BatchId, inserted.CallbackUrl
             WHERE Id = ?
-            """, (status, id))
+            """, (status, completed, *_callback_pending_params(completed), id))
+        row = cursor.fetchone()
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    if row:
+        _notify_status_listeners([
+            {"Id": id, "Status": status, "BatchId": row[0], "Result": result, "CallbackUrl": row[1]}
+        ])
+
+# Store the result of one batch line on every request it covers: all rows of the batch sharing the
+# fingerprint used as custom_id, or the single row whose id is the custom_id
+def update_batch_result(batch_id, custom_id, status, result=None):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        completed = datetime.now() if status in FINAL_STATUSES else None
+        cursor.execute(f"""
+        UPDATE BatchRequest
+        SET Status = ?, Result = ?, Completed = ?, {CALLBACK_PENDING_UPDATE}
+        OUTPUT inserted.Id, inserted.CallbackUrl
+        WHERE BatchId = ? AND (Fingerprint = ? OR Id = ?)
+        """, (status, result, completed, *_callback_pending_params(completed), batch_id, custom_id, custom_id))
+        rows = cursor.fetchall()
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    _notify_status_listeners([
+        {"Id": row[0], "Status": status, "BatchId": batch_id, "Result": result, "CallbackUrl": row[1]} for row in rows
+    ])
+    return [row[0] for row in rows]
+
+# Claim up to `limit` pending callbacks that are due, pushing their next attempt lease_seconds out so
+# other sweepers skip them while they are being delivered
+def claim_pending_callbacks(limit, lease_seconds):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+
+    try:
+        now = datetime.now()
+        cursor.execute("""
+        UPDATE TOP (?) BatchRequest WITH (UPDLOCK, READPAST)
+        SET CallbackNextAttempt = ?
+        OUTPUT inserted.Id, inserted.Status, inserted.BatchId, inserted.Result, inserted.CallbackUrl, inserted.CallbackAttempts
+        WHERE CallbackPending = 1 AND CallbackNextAttempt <= ?
+        """, (limit, now + timedelta(seconds=lease_seconds), now))
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+    return rows
+
+# Record a callback attempt. A callback that is done (delivered, refused or out of attempts) is no longer
+# pending; otherwise it is retried from next_attempt.
+def record_callback_attempt(id, done, next_attempt=None):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("""
+        UPDATE BatchRequest
+        SET CallbackPending = ?, CallbackAttempts = CallbackAttempts + 1, CallbackNextAttempt = ?
+        WHERE Id = ? AND CallbackPending = 1
+        """, (0 if done else 1, None if done else next_attempt, id))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+# Get the status and batch id of requests, as a dict keyed by request id, including archived requests
+def get_request_statuses(ids, chunk_size=2000):
+    statuses = {}
+    if not ids:
+        return statuses
+        
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            cursor.execute(f"""
+            SELECT Id, Status, BatchId FROM BatchRequest
+            WHERE Id IN ({','.join(['?' for _ in chunk])})
+            """, chunk)
+            for row in cursor.fetchall():
+                statuses[row[0]] = {"Status": row[1], "BatchId": row[2]}
+
+        # Requests moved to the archive by retention keep their final status
+        missing = [id for id in ids if id not in statuses]
+        for start in range(0, len(missing), chunk_size):
+            chunk = missing[start:start + chunk_size]
+            cursor.execute(f"""
+            SELECT Id, Status, BatchId FROM BatchRequestArchive
+            WHERE Id IN ({','.join(['?' for _ in chunk])})
+            """, chunk)
+            for row in cursor.fetchall():
+                statuses[row[0]] = {"Status": row[1], "BatchId": row[2]}
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return statuses
+
+# Store a response schema under its id, doing nothing if it is already registered
+def insert_response_schema(id, schema_json):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+        IF NOT EXISTS (SELECT 1 FROM ResponseSchema WHERE Id = ?)
+            INSERT INTO ResponseSchema (Id, SchemaJson, Created) VALUES (?, ?, ?)
+        """, (id, id, schema_json, datetime.now()))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+# Get the JSON text of a registered response schema, or None if it does not exist
+def get_response_schema(id):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT SchemaJson FROM ResponseSchema WHERE Id = ?", (id,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return row[0] if row else None
+
+# Stream requests matching a job id, a creation time range and/or a list of ids, one page of rows at a time,
+# including requests retention has moved to the archive table.
+# The forward-only cursor is read with fetchmany, so only one page is held in memory whatever the row count.
+def iter_request_results(job_id=None, since=None, until=None, ids=None, page_size=1000):
+    conditions = []
+    params = []
+    if job_id:
+        conditions.append("JobId = ?")
+        params.append(job_id)
+    if since:
+        conditions.append("Created >= ?")
+        params.append(since)
+    if until:
+        conditions.append("Created < ?")
+        params.append(until)
+    if ids:
+        conditions.append(f"Id IN ({','.join(['?' for _ in ids])})")
+        params.extend(ids)
+    if not conditions:
+        raise ValueError("At least one filter is required")
+
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        where = ' AND '.join(conditions)
+        cursor.execute(f"""
+        SELECT Id, JobId, BatchId, ModelDeploymentName, Status, Result, Created
+        FROM BatchRequest
+        WHERE {where}
+        UNION ALL
+        SELECT Id, JobId, BatchId, ModelDeploymentName, Status, Result, Created
+        FROM BatchRequestArchive
+        WHERE {where}
+        ORDER BY Created, Id
+        """, params + params)
+        
+        columns = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                break
+            yield [dict(zip(columns, row)) for row in rows]
+    finally:
+        cursor.close()
+        conn.close()
+
+# Columns moved from BatchRequest to BatchRequestArchive by archive_finished_requests, with their types
+ARCHIVE_COLUMNS = {
+    "Id": "NVARCHAR(50) PRIMARY KEY",
+    "ModelDeploymentName": "NVARCHAR(100)",
+    "ResponseJsonSchema": "NVARCHAR(MAX)",
+    "Instructions": "NVARCHAR(MAX)",
+    "Status": "NVARCHAR(50)",
+    "FileNames": "NVARCHAR(MAX)",
+    "BatchId": "NVARCHAR(50)",
+    "Result": "NVARCHAR(MAX)",
+    "Created": "DATETIME",
+    "SchemaId": "NVARCHAR(64)",
+    "JobId": "NVARCHAR(50)",
+    "CallbackUrl": "NVARCHAR(2048)",
+    "Fingerprint": "NVARCHAR(64)",
+    "TenantId": "NVARCHAR(100)",
+    "Completed": "DATETIME"
+}
+
+# Move up to batch_size requests that finished before older_than into the archive table, in one
+# transaction. Returns the number of archived requests and the blob URLs they referenced that no
+# remaining request references (e.g. a manifest row of a newer job pointing at the same blob), which
+# are therefore safe to delete. Runs with low deadlock priority and a short lock timeout so it gives
+# way to live traffic instead of blocking it. Requests with a webhook callback still pending stay
+# until it is done.
+def archive_finished_requests(older_than, batch_size):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    columns = ", ".join(ARCHIVE_COLUMNS)
+    
+    try:
+        # A DML statement can have only one OUTPUT INTO, so the deleted rows go to a table variable and
+        # both the archive insert and the blob reference delete read from it. XACT_ABORT rolls the whole
+        # move back if any statement fails, e.g. on a lock timeout.
+        cursor.execute(f"""
+        SET NOCOUNT ON;
+        SET XACT_ABORT ON;
+        SET DEADLOCK_PRIORITY LOW;
+        SET LOCK_TIMEOUT 5000;
+        DECLARE @archived TABLE ({", ".join(f"{column} {type}" for column, type in ARCHIVE_COLUMNS.items())});
+        DECLARE @released TABLE (BlobUrl NVARCHAR(MAX), BlobUrlHash BINARY(32));
+
+        BEGIN TRANSACTION;
+
+        DELETE TOP (?) FROM BatchRequest
+        OUTPUT {", ".join(f"deleted.{column}" for column in ARCHIVE_COLUMNS)} INTO @archived ({columns})
+        WHERE Status IN ('completed', 'failed') AND Completed < ? AND CallbackPending = 0;
+
+        INSERT INTO BatchRequestArchive ({columns}, Archived)
+        SELECT {columns}, GETDATE() FROM @archived;
+
+        DELETE FROM BatchRequestBlob
+        OUTPUT deleted.BlobUrl, deleted.BlobUrlHash INTO @released (BlobUrl, BlobUrlHash)
+        WHERE RequestId IN (SELECT Id FROM @archived);
+
+        SELECT COUNT(*) FROM @archived;
+
+        SELECT DISTINCT released.BlobUrl FROM @released released
+        WHERE NOT EXISTS (
+            SELECT 1 FROM BatchRequestBlob remaining
+            WHERE remaining.BlobUrlHash = released.BlobUrlHash AND remaining.BlobUrl = released.BlobUrl
+        );
+
+        COMMIT TRANSACTION;
+        """, (batch_size, older_than))
+        archived = cursor.fetchone()[0]
+        cursor.nextset()
+        unreferenced_urls = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return archived, unreferenced_urls
+
+# Delete up to batch_size archived requests archived before older_than, returning how many were deleted
+def purge_archived_requests(older_than, batch_size):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+        SET DEADLOCK_PRIORITY LOW;
+        SET LOCK_TIMEOUT 5000;
+        DELETE TOP (?) FROM BatchRequestArchive
+        WHERE Archived < ?
+        """, (batch_size, older_than))
+        deleted = cursor.rowcount
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return deleted
+
+# Count queued, dispatching and processing requests per tenant, with the creation time of the oldest one of each
+def get_tenant_queue_stats():
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    stats = []
+    
+    try:
+        cursor.execute("""
+        SELECT TenantId, Status, COUNT(*), MIN(Created)
+        FROM BatchRequest
+        WHERE Status IN ('queued', 'dispatching', 'processing')
+        GROUP BY TenantId, Status
+        """)
+        for row in cursor.fetchall():
+            stats.append({"TenantId": row[0], "Status": row[1], "Count": row[2], "Oldest": row[3]})
+    finally:
+        cursor.close()
+        conn.close()
+    
+    return stats
+
+# Take an exclusive application lock for a background job, so only one process of the deployment runs
+# it at a time. Returns the connection holding the lock, to pass to release_app_lock, or None if
+# another process holds it.
+def acquire_app_lock(resource):
+    conn = get_sql_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("""
+        SET NOCOUNT ON;
+        DECLARE @result INT;
+        EXEC @result = sp_getapplock @Resource = ?, @LockMode = 'Exclusive', @LockOwner = 'Session', @LockTimeout = 0;
+        SELECT @result;
+        """, (resource,))
+        acquired = cursor.fetchone()[0] >= 0
+    finally:
+        cursor.close()
+    
+    if not acquired:
+        conn.close()
+        return None
+    return conn
+
+# Release a lock taken with acquire_app_lock and close its connection. The lock is released explicitly
+# because with ODBC pooling a closed connection stays open, and keeps its session locks, in the pool.
+def release_app_lock(conn, resource):
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("EXEC sp_releaseapplock @Resource = ?, @LockOwner = 'Session'", (resource,))
         conn.commit()
     finally:
         cursor.close()
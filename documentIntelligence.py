@@ -1,9 +1,237 @@
 import os
-from azure.ai.formrecognizer import DocumentAnalysisClient
-from azure.core.credentials import AzureKeyCredential
-from dotenv import load_dotenv
+import io
+import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import config  # loads .env once per process
 
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=None)
+def get_document_analysis_client():
+    """
+    Create the Document Intelligence client on first use and reuse it (and its connection pool) afterwards.
+    The SDK is imported here so it is only loaded once a document is actually analyzed.
+
+    Returns:
+        DocumentAnalysisClient: Shared client for the configured endpoint
+    """
+    from azure.ai.formrecognizer import DocumentAnalysisClient
+    from azure.core.credentials import AzureKeyCredential
+
+    return DocumentAnalysisClient(
+        endpoint=os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT"), 
+        credential=AzureKeyCredential(os.getenv("DOCUMENT_INTELLIGENCE_API_KEY"))
+    )
+
+def analyze_document(document_content):
+    """
+    Run the prebuilt-layout model on a document and wait for the result.
+    
+    Args:
+        document_content (bytes or file-like): The document
+    
+    Returns:
+        AnalyzeResult: Result from Document Intelligence
+    """
+    poller = get_document_analysis_client().begin_analyze_document(
+        "prebuilt-layout",
+        document_content
+    )
+    return poller.result()
+
+def count_pdf_pages(document_content):
+    """
+    Count the pages of a PDF locally.
+    
+    Args:
+        document_content (bytes): The document
+    
+    Returns:
+        int: Number of pages, or None if the document is not a PDF pypdf can read or pypdf is not installed
+    """
+    if not document_content.startswith(b"%PDF"):
+        return None
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        logger.warning("pypdf is not installed, large PDFs will not be split into page ranges")
+        return None
+    try:
+        return len(PdfReader(io.BytesIO(document_content)).pages)
+    except Exception as e:
+        # Document Intelligence may still read a PDF pypdf cannot, so analyze it whole
+        logger.warning(f"Could not read the PDF page count, analyzing the document unsplit: {str(e)}")
+        return None
+
+def pdf_subset(reader, page_indexes):
+    """
+    Build a new PDF from some pages of another one.
+    
+    Args:
+        reader (PdfReader): The source PDF
+        page_indexes (iterable): 0-based indexes of the pages to keep, in order
+    
+    Returns:
+        bytes: The new PDF
+    """
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for index in page_indexes:
+        writer.add_page(reader.pages[index])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+def _page_texts(result):
+    """
+    Slice the content of a result into the text of each of its pages, using the page spans.
+    
+    Args:
+        result (AnalyzeResult): Result from Document Intelligence
+    
+    Returns:
+        list: Text of each page, in page order
+    """
+    return [
+        "".join(result.content[span.offset:span.offset + span.length] for span in page.spans)
+        for page in sorted(result.pages, key=lambda page: page.page_number)
+    ]
+
+def _table_continues_onto(result, page_number):
+    """
+    Check whether a table that starts before page_number continues onto it.
+    
+    Args:
+        result (AnalyzeResult): Result from Document Intelligence
+        page_number (int): 1-based page number within the result
+    
+    Returns:
+        bool: True if such a table exists
+    """
+    for table in result.tables or []:
+        pages = [region.page_number for region in table.bounding_regions or []]
+        if pages and min(pages) < page_number <= max(pages):
+            return True
+    return False
+
+def analyze_in_page_ranges(document_content, page_count, pages_per_range, max_parallel):
+    """
+    Split a PDF into page ranges, analyze the ranges concurrently and stitch the text back in page order.
+    
+    Consecutive ranges overlap by one page, so each boundary page is analyzed twice. The later range
+    keeps it, unless a table in the earlier range already runs onto it, in which case the earlier range
+    keeps it. A table that starts or ends on the boundary page is therefore analyzed whole by one range.
+    A table that runs past the boundary page on both sides (e.g. pages 4-6 with the boundary on page 5)
+    is still split between two calls. Either way, no page is lost or duplicated.
+    
+    Args:
+        document_content (bytes): The PDF
+        page_count (int): Number of pages in the PDF
+        pages_per_range (int): Pages per range, not counting the overlap page
+        max_parallel (int): Maximum number of concurrent analyze calls
+    
+    Returns:
+        list: Text of each page of the document, in page order
+    """
+    from pypdf import PdfReader
+
+    # (start, end) page indexes, end exclusive; each range also includes the first page of the next one
+    ranges = [(start, min(start + pages_per_range + 1, page_count)) for start in range(0, page_count - 1, pages_per_range)]
+
+    reader = PdfReader(io.BytesIO(document_content))
+    parts = [pdf_subset(reader, range(start, end)) for start, end in ranges]
+
+    logger.info(f"Analyzing {page_count} pages in {len(ranges)} ranges with up to {max_parallel} concurrent calls")
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        results = list(executor.map(analyze_document, parts))
+
+    # Decide who keeps each overlap page first, then slice, so dropping a page does not shift the next boundary
+    drop_first = [False] * len(results)
+    drop_last = [False] * len(results)
+    for i in range(len(results) - 1):
+        boundary = ranges[i][1] - ranges[i][0]  # local number of the overlap page in range i
+        if _table_continues_onto(results[i], boundary):
+            drop_first[i + 1] = True
+        else:
+            drop_last[i] = True
+
+    stitched = []
+    for i, result in enumerate(results):
+        texts = _page_texts(result)
+        stitched.extend(texts[1 if drop_first[i] else 0:len(texts) - 1 if drop_last[i] else len(texts)])
+    return stitched
+
+def _split_page_count(document_content):
+    """Page count of a PDF that should be analyzed in page ranges, or None to analyze it whole"""
+    pages_per_range = config.get_int("DOCUMENT_INTELLIGENCE_SPLIT_PAGES", 0)
+    if pages_per_range > 0:
+        page_count = count_pdf_pages(document_content)
+        if page_count and page_count > pages_per_range:
+            return page_count
+    return None
+
+def analyze_document_pages(document_content, page_count=None):
+    """
+    Analyze a document and return the text of each page, splitting large PDFs into page ranges.
+    
+    Args:
+        document_content (bytes): The document
+        page_count (int, optional): Result of _split_page_count, when the caller already has it
+    
+    Returns:
+        list: Text of each page, in page order
+    """
+    page_count = page_count or _split_page_count(document_content)
+    if page_count:
+        return analyze_in_page_ranges(
+            document_content,
+            page_count,
+            config.get_int("DOCUMENT_INTELLIGENCE_SPLIT_PAGES", 0),
+            config.get_int("DOCUMENT_INTELLIGENCE_MAX_PARALLEL", 4)
+        )
+    return _page_texts(analyze_document(document_content))
+
+def document_content_to_text(document_content):
+    """
+    Analyze a document held in memory and return its text content.
+    PDFs longer than DOCUMENT_INTELLIGENCE_SPLIT_PAGES pages are analyzed in concurrent page ranges.
+    
+    Args:
+        document_content (bytes): The document
+    
+    Returns:
+        str: Text content of the document
+    """
+    # Large PDFs: latency grows with pages / parallelism instead of with the page count
+    page_count = _split_page_count(document_content)
+    if page_count:
+        return "\n".join(analyze_document_pages(document_content, page_count))
+    
+    result = analyze_document(document_content)
+    
+    # Return the raw result as a dictionary
+    return result.content
+
+def process_upload_to_markdown(stream):
+    """
+    Analyze a document from a seekable binary stream, such as a spooled upload, without staging it on disk.
+    The stream is handed to the SDK as is unless the document has to be split into page ranges.
+    
+    Args:
+        stream (file-like): Seekable binary stream of the document
+    
+    Returns:
+        str: Text content of the document
+    """
+    stream.seek(0)
+    if config.get_int("DOCUMENT_INTELLIGENCE_SPLIT_PAGES", 0) > 0 and stream.read(4) == b"%PDF":
+        stream.seek(0)
+        return document_content_to_text(stream.read())
+    
+    stream.seek(0)
+    return analyze_document(stream).content
 
 def process_document_to_markdown(file_path):
     """
@@ -13,24 +241,12 @@ def process_document_to_markdown(file_path):
         file_path (str): Path to the document file to process
     
     Returns:
-        dict: Raw result from Document Intelligence
+        str: Text content of the document
     """
-    document_analysis_client = DocumentAnalysisClient(
-        endpoint=os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT"), 
-        credential=AzureKeyCredential(os.getenv("DOCUMENT_INTELLIGENCE_API_KEY"))
-    )
-    
     if not os.path.isfile(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
     
     with open(file_path, "rb") as f:
         document_content = f.read()
     
-    poller = document_analysis_client.begin_analyze_document(
-        "prebuilt-layout",
-        document_content
-    )
-    result = poller.result()
-    
-    # Return the raw result as a dictionary
-    return result.content
+    return document_content_to_text(document_content)
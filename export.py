@@ -0,0 +1,121 @@
+# Streaming export of request results as NDJSON or Parquet, optionally gzip compressed.
+# Every encoder consumes pages from db.iter_request_results and yields bytes, so memory stays
+# constant regardless of how many rows are exported.
+import json
+import zlib
+import tempfile
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+# Rows are exported with these keys, in this order
+EXPORT_COLUMNS = ["id", "job_id", "batch_id", "model_deployment_name", "status", "result", "created"]
+CHUNK_SIZE = 64 * 1024
+
+def _export_row(row):
+    """
+    Convert a BatchRequest row into an export record.
+
+    Args:
+        row (dict): Row from iter_request_results
+
+    Returns:
+        dict: Record with EXPORT_COLUMNS keys; result is parsed JSON when possible
+    """
+    result = row["Result"]
+    if result:
+        try:
+            result = json.loads(result)
+        except json.JSONDecodeError:
+            pass
+    return {
+        "id": row["Id"],
+        "job_id": row["JobId"],
+        "batch_id": row["BatchId"],
+        "model_deployment_name": row["ModelDeploymentName"],
+        "status": row["Status"],
+        "result": result,
+        "created": row["Created"].isoformat() if row["Created"] else None,
+    }
+
+def ndjson_chunks(pages):
+    """
+    Encode pages of rows as NDJSON, one chunk per page.
+
+    Args:
+        pages (iterable): Pages (lists) of BatchRequest rows
+
+    Yields:
+        bytes: Encoded lines of one page
+    """
+    for page in pages:
+        yield "".join(json.dumps(_export_row(row), ensure_ascii=False) + "\n" for row in page).encode("utf-8")
+
+def parquet_chunks(pages):
+    """
+    Encode pages of rows as a Parquet file, one row group per page. Parquet needs its footer written
+    last, so the file is built in a spooled temporary file (on disk past a few MB) and then streamed.
+
+    Args:
+        pages (iterable): Pages (lists) of BatchRequest rows
+
+    Yields:
+        bytes: Chunks of the Parquet file
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Results have arbitrary shapes, so they are kept as JSON text in a string column
+    schema = pa.schema([(name, pa.string()) for name in EXPORT_COLUMNS])
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as buffer:
+        with pq.ParquetWriter(buffer, schema, compression="zstd") as writer:
+            for page in pages:
+                records = [_export_row(row) for row in page]
+                for record in records:
+                    if record["result"] is not None and not isinstance(record["result"], str):
+                        record["result"] = json.dumps(record["result"], ensure_ascii=False)
+                writer.write_table(pa.Table.from_pylist(records, schema=schema))
+        buffer.seek(0)
+        while True:
+            chunk = buffer.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+def gzip_chunks(chunks):
+    """
+    Gzip-compress a stream of byte chunks incrementally.
+
+    Args:
+        chunks (iterable): Uncompressed byte chunks
+
+    Yields:
+        bytes: Compressed chunks
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def export_results(pages, format="ndjson", compression=None):
+    """
+    Build the byte stream of an export.
+
+    Args:
+        pages (iterable): Pages of BatchRequest rows
+        format (str): "ndjson" or "parquet"
+        compression (str, optional): "gzip" or None
+
+    Returns:
+        iterator: Byte chunks of the export
+    """
+    if format == "parquet":
+        chunks = parquet_chunks(pages)
+    else:
+        chunks = ndjson_chunks(pages)
+    if compression == "gzip":
+        chunks = gzip_chunks(chunks)
+    return chunks
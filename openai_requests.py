@@ -1,53 +1,97 @@
+import io
 import os
 import json
-import requests
-from dotenv import load_dotenv
-from openai import AzureOpenAI
 import base64
+from functools import lru_cache
 from mimetypes import guess_type
+import config  # loads .env once per process
 
 
-load_dotenv()
+@lru_cache(maxsize=32)
+def get_openai_client(api_key, api_version, base_url):
+    # The OpenAI SDK is imported on first use, and one client (with its connection pool) is kept per target
+    from openai import AzureOpenAI
+
+    return AzureOpenAI(
+        api_key=api_key,
+        api_version=api_version,
+        base_url=base_url
+    )
+
+class BatchUploadError(Exception):
+    """Raised when a batch upload fails. batches holds the batches uploaded before the failure."""
+    def __init__(self, message, batches):
+        super().__init__(message)
+        self.batches = batches
 
 def create_jsonl_and_upload(requests_list):
+    """
+    Pack queued requests into one JSONL batch per deployment and upload them. Requests with the same
+    fingerprint are identical, so they are written once, as a single line whose custom_id is the
+    fingerprint (or the request id for rows without one); db.update_batch_result copies the result
+    of that line back to every request.
+
+    Args:
+        requests_list (list): Queued BatchRequest rows as dicts
+
+    Returns:
+        dict: Mapping of batch id to the ids of all requests it covers
+
+    Raises:
+        BatchUploadError: If an upload fails; its batches were submitted before the failure
+    """
     # Ensure requests_list is not empty
     if not requests_list:
         raise ValueError("requests_list cannot be empty")
     
-    batch_ids = []
-    
+    import requests
+    from coalesce import coalesce_requests
+
+    # Group requests by deployment, then collapse duplicates within each deployment
+    by_deployment = {}
     for req in requests_list:
         # Get model_deployment_name from each request
         model_deployment_name = req.get("ModelDeploymentName")
         if not model_deployment_name:
             raise ValueError("ModelDeploymentName not found in a request")
-        
-        # Create JSONL file for this request
-        jsonl_filename = f"batch_{model_deployment_name}_{len(batch_ids)}.jsonl"
-        with open(jsonl_filename, "w", encoding="utf-8") as f:
-            # Write a single JSON object
-            f.write(json.dumps({
+        by_deployment.setdefault(model_deployment_name, []).append(req)
+
+    batches = {}
+    
+    for model_deployment_name, deployment_requests in by_deployment.items():
+        groups = coalesce_requests(deployment_requests)
+
+        # Build the JSONL body for this deployment in memory, one line per distinct request. No file is
+        # written, so concurrent dispatchers cannot overwrite each other's batches.
+        body = io.BytesIO()
+        for custom_id, group in groups.items():
+            req = group[0]
+            body.write((json.dumps({
+                "custom_id": custom_id,
                 "instructions": req["Instructions"],
-                "response_json": req["ResponseJson"],
+                "response_json": req["ResponseJsonSchema"],
                 "file_names": req["FileNames"].split(",")
-            }) + "\n")
+            }) + "\n").encode("utf-8"))
+        body.seek(0)
             
         # Upload to Azure OpenAI batch endpoint
-        url = f"{os.environ.get("OPENAI_ENDPOINT")}/openai/deployments/{model_deployment_name}/batch/jobs?api-version=2024-02-15-preview" #2025-01-01-preview
+        url = f"{os.environ.get('OPENAI_ENDPOINT')}/openai/deployments/{model_deployment_name}/batch/jobs?api-version=2024-02-15-preview" #2025-01-01-preview
         headers = {
             "api-key": os.environ.get("OPENAI_API_KEY"),
             "Content-Type": "application/jsonl"
         }
-        with open(jsonl_filename, "rb") as f:
-            response = requests.post(url, headers=headers, data=f)
+        try:
+            response = requests.post(url, headers=headers, data=body)
+        except Exception as e:
+            raise BatchUploadError(f"Failed to upload batch for {model_deployment_name}: {str(e)}", batches) from e
             
         if response.status_code == 200 or response.status_code == 201:
             batch_id = response.json().get("id")
-            batch_ids.append(batch_id)
+            batches[batch_id] = [req["Id"] for group in groups.values() for req in group]
         else:
-            raise Exception(f"Failed to upload batch: {response.status_code} {response.text}")
+            raise BatchUploadError(f"Failed to upload batch: {response.status_code} {response.text}", batches)
     
-    return batch_ids
+    return batches
 
 def send_request(markdown:str, instructions:str, model_deployment_name:str, structuredOutputJson:dict, model_base_url=None, model_api_version=None, model_api_key=None):
     # Use provided parameters or fall back to environment variables
@@ -55,11 +99,7 @@ def send_request(markdown:str, instructions:str, model_deployment_name:str, stru
     api_key = model_api_key or os.getenv("OPENAI_API_KEY")
     api_version = model_api_version or os.getenv("OPENAI_API_VERSION")
 
-    client = AzureOpenAI(
-        api_key=api_key,
-        api_version=api_version,
-        base_url=f"{api_base}={api_version}"
-    )
+    client = get_openai_client(api_key, api_version, f"{api_base}={api_version}")
 
     userPrompt = {
         "role": "user",
@@ -85,11 +125,7 @@ def send_request_vision(files: list, instructions: str, model_deployment_name: s
     deployment_name = model_deployment_name
     api_version = os.getenv("OPENAI_API_VERSION")
 
-    client = AzureOpenAI(
-        api_key=api_key,  
-        api_version=api_version,
-        base_url=f"{api_base}/openai/deployments/{deployment_name}"
-    )
+    client = get_openai_client(api_key, api_version, f"{api_base}/openai/deployments/{deployment_name}")
     
     userPrompt = { "role": "user", "content": [  
                 { 
@@ -98,12 +134,16 @@ def send_request_vision(files: list, instructions: str, model_deployment_name: s
                 }
             ] } 
     
-    # Add each file as image content to the prompt
+    # Add each file as image content to the prompt; files are paths or (file name, binary stream) tuples
     for file in files:
+        if isinstance(file, str):
+            data_url = local_image_to_data_url(file)
+        else:
+            data_url = stream_to_data_url(*file)
         userPrompt["content"].append({ 
             "type": "image_url",
             "image_url": {
-                "url": local_image_to_data_url(file)
+                "url": data_url
             }
         })
 
@@ -132,6 +172,19 @@ def local_image_to_data_url(image_path):
     # Construct the data URL
     return f"data:{mime_type};base64,{base64_encoded_data}"
 
+def stream_to_data_url(file_name, stream, chunk_size=3 * 256 * 1024):
+    # Guess the MIME type of the image based on the file name
+    mime_type, _ = guess_type(file_name)
+    if mime_type is None:
+        mime_type = 'application/octet-stream'  # Default MIME type if none is found
+
+    # Encode in chunks (a multiple of 3 bytes, so no padding mid-stream) instead of reading the whole file first
+    stream.seek(0)
+    encoded_chunks = [f"data:{mime_type};base64,"]
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        encoded_chunks.append(base64.b64encode(chunk).decode('ascii'))
+    return "".join(encoded_chunks)
+
 
 if __name__ == "__main__":
     # Example usage
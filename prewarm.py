@@ -0,0 +1,97 @@
+# Background pre-warming of SDKs and remote endpoints, so the first request after a cold start or
+# scale-out does not pay for SDK imports, client construction and DNS lookups. Only the blob client
+# keeps a warm TLS connection; the other targets are warmed up to the point before a connection is
+# reused, see each warmer.
+import os
+import socket
+import logging
+import threading
+from urllib.parse import urlparse
+import config
+
+logger = logging.getLogger(__name__)
+
+def _resolve(url):
+    """
+    Resolve the host of a URL so the lookup is cached by the OS resolver before first use.
+
+    Args:
+        url (str): Endpoint URL, may be None
+    """
+    host = urlparse(url).hostname if url else None
+    if host:
+        socket.getaddrinfo(host, 443, proto=socket.IPPROTO_TCP)
+
+def _warm_blob():
+    from blob import get_blob_service_client
+
+    # A cheap authenticated call opens the TLS connection inside the shared client's pool
+    get_blob_service_client().get_container_client("document-processing").exists()
+
+def _warm_document_intelligence():
+    from documentIntelligence import get_document_analysis_client
+
+    # DNS and client construction only: the SDK opens its TLS connection on the first real call
+    _resolve(os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT"))
+    get_document_analysis_client()
+
+def _warm_openai():
+    from openai_requests import get_openai_client
+
+    _resolve(os.getenv("OPENAI_ENDPOINT"))
+    # Importing the SDK and building the client is most of its cold-start cost; as with Document
+    # Intelligence, the TLS connection is only opened by the first request
+    api_version = os.getenv("OPENAI_API_VERSION")
+    get_openai_client(os.getenv("OPENAI_API_KEY"), api_version, f"{os.getenv('OPENAI_ENDPOINT')}={api_version}")
+
+def _warm_sql():
+    from db import get_sql_connection
+
+    # Loads the ODBC driver and checks the login. The connection is closed, not pooled: unixODBC
+    # pooling is off unless enabled in odbcinst.ini, so the first request still opens its own
+    conn = get_sql_connection()
+    conn.close()
+
+WARMERS = {
+    "blob": _warm_blob,
+    "document_intelligence": _warm_document_intelligence,
+    "openai": _warm_openai,
+    "sql": _warm_sql,
+}
+
+def prewarm(targets=None):
+    """
+    Warm the given targets one after the other, logging (not raising) any failure.
+
+    Args:
+        targets (list, optional): Names from WARMERS; defaults to all of them
+
+    Returns:
+        dict: Mapping of target name to True if it was warmed successfully
+    """
+    results = {}
+    for name in targets or WARMERS:
+        try:
+            WARMERS[name]()
+            results[name] = True
+        except Exception as e:
+            logger.warning(f"Pre-warming {name} failed: {str(e)}")
+            results[name] = False
+    logger.info(f"Pre-warming finished: {results}")
+    return results
+
+def start_prewarm():
+    """
+    Start pre-warming in a daemon thread when PREWARM_ON_STARTUP is enabled.
+    PREWARM_TARGETS optionally restricts it to a comma separated subset of blob, document_intelligence, openai, sql.
+
+    Returns:
+        threading.Thread: The started thread, or None when pre-warming is disabled
+    """
+    if not config.get_bool("PREWARM_ON_STARTUP"):
+        return None
+
+    targets = [t.strip() for t in config.get_setting("PREWARM_TARGETS", "").split(",") if t.strip() in WARMERS]
+    thread = threading.Thread(target=prewarm, args=(targets or None,), name="prewarm", daemon=True)
+    thread.start()
+    return thread
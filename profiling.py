@@ -0,0 +1,181 @@
+import os
+import sys
+import asyncio
+import time
+import uuid
+import random
+import hmac
+import logging
+import cProfile
+import threading
+from collections import Counter
+import config
+
+logger = logging.getLogger(__name__)
+
+# Header used to ask for a profile of a single request. Its value must match PROFILING_TOKEN.
+PROFILE_HEADER = b"x-profile-token"
+REQUEST_ID_HEADER = b"x-request-id"
+
+def _stack_key(frame):
+    """
+    Build a collapsed stack string (root first, frames separated by ';') from a frame.
+
+    Args:
+        frame (frame): Innermost frame of the sampled thread
+
+    Returns:
+        str: Stack in the "collapsed" format understood by flamegraph.pl and speedscope
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class WallClockSampler:
+    """
+    Samples the stacks of the process's threads at a fixed interval, independently of whether they
+    are running on the CPU, so time spent waiting on the network shows up in the profile. Work that
+    a request hands to run_in_threadpool runs on worker threads, so those are sampled too; each
+    stack is rooted at its thread's name so the event loop and each worker stay apart in the graph
+    (idle pool threads show up as their own, easily ignored, waiting stacks).
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="wall-clock-sampler", daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                thread_name = names.get(thread_id, str(thread_id))
+                self.samples[f"{thread_name};{_stack_key(frame)}"] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+def write_profile(request_id, cpu_profile, sampler, elapsed):
+    """
+    Write the CPU profile (pstats) and the wall-clock profile (collapsed stacks) of a request.
+    Files go to PROFILING_DIR and, when PROFILING_CONTAINER is set, are also uploaded to blob storage.
+
+    Args:
+        request_id (str): Id of the profiled request, used in the file names
+        cpu_profile (cProfile.Profile): Stopped CPU profiler
+        sampler (WallClockSampler): Stopped wall-clock sampler
+        elapsed (float): Wall-clock duration of the request in seconds
+
+    Returns:
+        list: Paths of the written profile files
+    """
+    profile_dir = config.get_setting("PROFILING_DIR", "profiles")
+    os.makedirs(profile_dir, exist_ok=True)
+
+    cpu_path = os.path.join(profile_dir, f"{request_id}.cpu.pstats")
+    wall_path = os.path.join(profile_dir, f"{request_id}.wall.collapsed")
+    cpu_profile.dump_stats(cpu_path)
+    with open(wall_path, "w", encoding="utf-8") as f:
+        f.write(sampler.collapsed())
+    logger.info(f"Profile for request {request_id} ({elapsed * 1000:.1f} ms) written to {profile_dir}")
+
+    container_name = config.get_setting("PROFILING_CONTAINER")
+    if container_name:
+        # Imported here so the blob SDK is only loaded when profiles are actually shipped
+        from blob import upload_multiple_files
+        upload_multiple_files(container_name, [cpu_path, wall_path])
+
+    return [cpu_path, wall_path]
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles opted-in requests. A request is profiled when it carries an
+    X-Profile-Token header matching PROFILING_TOKEN, or when it falls in the PROFILING_SAMPLE_RATE
+    fraction of traffic. Requests that are not profiled only pay for a header lookup and a random draw.
+    """
+    def __init__(self, app, token=None, sample_rate=0.0):
+        self.app = app
+        self.token = token.encode() if token else None
+        self.sample_rate = sample_rate
+        # Only one request is profiled at a time; other requests sharing the event loop thread
+        # while it runs will still show up in its CPU profile
+        self._lock = threading.Lock()
+
+    def _wants_profile(self, scope):
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == PROFILE_HEADER:
+                    return hmac.compare_digest(value, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wants_profile(scope) or not self._lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER:
+                request_id = value.decode("latin-1")
+        # Keep the id safe to use as a file and blob name, and unique so profiles of requests
+        # sharing (or replaying) an X-Request-ID do not overwrite each other
+        if not request_id or not request_id.replace("-", "").isalnum():
+            request_id = str(uuid.uuid4())
+        else:
+            request_id = f"{request_id[:64]}-{uuid.uuid4().hex[:8]}"
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", request_id.encode())]
+            await send(message)
+
+        # cProfile only sees the event loop thread; worker threads are covered by the wall-clock sampler
+        cpu_profile = cProfile.Profile()
+        sampler = WallClockSampler()
+        start = time.perf_counter()
+        try:
+            sampler.start()
+            cpu_profile.enable()
+            await self.app(scope, receive, send_with_id)
+        finally:
+            cpu_profile.disable()
+            sampler.stop()
+            try:
+                await asyncio.to_thread(write_profile, request_id, cpu_profile, sampler, time.perf_counter() - start)
+            except Exception as e:
+                logger.error(f"Error writing profile for request {request_id}: {str(e)}")
+            finally:
+                self._lock.release()
+
+def add_profiling(app):
+    """
+    Install the profiling middleware on the app when PROFILING_TOKEN or PROFILING_SAMPLE_RATE is set.
+    Nothing is installed otherwise, so unprofiled deployments have no overhead at all.
+
+    Args:
+        app (FastAPI): The application to instrument
+    """
+    token = config.get_setting("PROFILING_TOKEN")
+    try:
+        sample_rate = config.get_float("PROFILING_SAMPLE_RATE", 0.0)
+    except ValueError:
+        # A bad profiling setting must not keep the API from starting
+        logger.warning("Ignoring PROFILING_SAMPLE_RATE: not a number")
+        sample_rate = 0.0
+    if token or sample_rate > 0:
+        app.add_middleware(ProfilingMiddleware, token=token, sample_rate=sample_rate)
+        logger.info(f"Request profiling enabled (token: {'yes' if token else 'no'}, sample rate: {sample_rate})")
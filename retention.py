@@ -0,0 +1,94 @@
+# Retention for the BatchRequest table and the document-processing blob container. Requests that
+# finished more than RETENTION_DAYS ago are moved to BatchRequestArchive in small batches and the
+# documents no remaining request references are deleted in bulk; archived rows are purged after
+# ARCHIVE_RETENTION_DAYS. The job runs in a background thread, pauses between batches so it does not
+# compete with live traffic, and takes a SQL application lock so only one process runs a pass at a time.
+import logging
+import threading
+from datetime import datetime, timedelta
+import config
+from db import archive_finished_requests, purge_archived_requests, acquire_app_lock, release_app_lock
+from blob import delete_blobs
+
+logger = logging.getLogger(__name__)
+
+CONTAINER_NAME = "document-processing"
+LOCK_RESOURCE = "document-processing-retention"
+
+def run_retention_once(stop_event=None):
+    """
+    Run one retention pass: archive finished requests and delete the blobs no other request uses,
+    then purge old archive rows. Skipped when another process is running a pass.
+
+    Args:
+        stop_event (threading.Event, optional): Set to stop the pass between batches
+
+    Returns:
+        dict: Numbers of archived requests, deleted blobs and purged archive rows, or None if skipped
+    """
+    lock = acquire_app_lock(LOCK_RESOURCE)
+    if lock is None:
+        logger.info("Retention pass skipped: another process is running one")
+        return None
+    try:
+        return _run_retention_pass(stop_event or threading.Event())
+    finally:
+        release_app_lock(lock, LOCK_RESOURCE)
+
+def _run_retention_pass(stop_event):
+    retention_days = config.get_int("RETENTION_DAYS", 30)
+    archive_retention_days = config.get_int("ARCHIVE_RETENTION_DAYS", 0)
+    batch_size = config.get_int("RETENTION_BATCH_SIZE", 500)
+    batch_delay = config.get_float("RETENTION_BATCH_DELAY_SECONDS", 1.0)
+    max_batches = config.get_int("RETENTION_MAX_BATCHES_PER_RUN", 200)
+    stats = {"archived": 0, "blobs_deleted": 0, "archive_purged": 0}
+
+    cutoff = datetime.now() - timedelta(days=retention_days)
+    for _ in range(max_batches):
+        archived, urls = archive_finished_requests(cutoff, batch_size)
+        stats["archived"] += archived
+        if urls:
+            # Only URLs no remaining request references. Blobs uploaded again after the cutoff
+            # (e.g. same file name) belong to newer requests and are kept as well.
+            stats["blobs_deleted"] += delete_blobs(CONTAINER_NAME, urls, if_unmodified_since=cutoff)
+        if archived < batch_size or stop_event.wait(batch_delay):
+            break
+
+    if archive_retention_days > 0:
+        archive_cutoff = datetime.now() - timedelta(days=archive_retention_days)
+        for _ in range(max_batches):
+            purged = purge_archived_requests(archive_cutoff, batch_size)
+            stats["archive_purged"] += purged
+            if purged < batch_size or stop_event.wait(batch_delay):
+                break
+
+    logger.info(f"Retention pass finished: {stats}")
+    return stats
+
+def _retention_loop(stop_event):
+    interval = config.get_float("RETENTION_INTERVAL_SECONDS", 3600)
+    while not stop_event.is_set():
+        try:
+            run_retention_once(stop_event)
+        except Exception as e:
+            logger.error(f"Error running retention: {str(e)}")
+        stop_event.wait(interval)
+
+def start_retention():
+    """
+    Start the retention job in a daemon thread when RETENTION_ENABLED is set.
+
+    Returns:
+        threading.Event: Set it to stop the job, or None when retention is disabled
+    """
+    if not config.get_bool("RETENTION_ENABLED"):
+        return None
+
+    stop_event = threading.Event()
+    threading.Thread(target=_retention_loop, args=(stop_event,), name="retention", daemon=True).start()
+    logger.info("Retention job started")
+    return stop_event
+
+if __name__ == "__main__":
+    # Run a single pass, e.g. from a scheduled job instead of the API process
+    print(run_retention_once())
@@ -0,0 +1,202 @@
+# Weighted fair dispatch of queued requests across tenants. Each dispatch fills a batch by weighted
+# fair queueing over the tenants' queues, caps the work each tenant can have in flight, and lets each
+# tenant's oldest request go first once it passes a starvation threshold so no tenant waits indefinitely.
+# Requests are claimed before they are submitted, so concurrent dispatchers never submit a row twice.
+import heapq
+import logging
+from datetime import datetime, timedelta
+import config
+from db import (
+    get_queued_requests, get_tenant_queue_stats, update_requests_to_processing,
+    claim_queued_requests, release_claimed_requests
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT = "default"
+# Statuses that count as a tenant's work in flight
+IN_FLIGHT_STATUSES = ("dispatching", "processing")
+
+def parse_tenant_weights(value):
+    """
+    Parse tenant weights from "tenant_a=3,tenant_b=0.5". Tenants not listed have weight 1.
+
+    Args:
+        value (str): Weights setting, may be None
+
+    Returns:
+        dict: Tenant id -> weight
+    """
+    weights = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            tenant, weight = item.split("=", 1)
+            weights[tenant.strip()] = max(float(weight), 0.01)
+    return weights
+
+def select_fair_batch(queued_rows, capacity, in_flight=None, weights=None, max_in_flight=None,
+                      starvation_seconds=None, now=None):
+    """
+    Choose which queued requests go into the next batch.
+
+    Each tenant whose oldest request has waited starvation_seconds or more gets that one request
+    taken first, oldest first. Only one per tenant, so a tenant whose whole backlog is old still gets
+    its fair share and no more. The remaining capacity is shared by weighted fair queueing: a tenant's
+    k-th request gets the virtual finish time (in_flight + k) / weight, and requests are taken in order
+    of that time, oldest first on ties. Counting work already in flight means a tenant that got a large
+    share earlier gets less now. A tenant never gets more than max_in_flight requests in flight in total.
+
+    Args:
+        queued_rows (list): Queued BatchRequest rows, oldest first
+        capacity (int): Maximum number of requests in the batch
+        in_flight (dict, optional): Tenant id -> number of requests currently dispatching or processing
+        weights (dict, optional): Tenant id -> weight (default 1)
+        max_in_flight (int, optional): Per-tenant cap on requests in flight
+        starvation_seconds (float, optional): Age after which a tenant's oldest request jumps the fair order
+        now (datetime, optional): Current time, for tests
+
+    Returns:
+        list: Selected rows
+    """
+    in_flight = dict(in_flight or {})
+    weights = weights or {}
+    now = now or datetime.now()
+
+    queues = {}
+    for row in queued_rows:
+        queues.setdefault(row.get("TenantId") or DEFAULT_TENANT, []).append(row)
+
+    def has_room(tenant):
+        return max_in_flight is None or in_flight.get(tenant, 0) < max_in_flight
+
+    selected = []
+    taken = set()
+
+    def take(tenant, row):
+        selected.append(row)
+        taken.add(row["Id"])
+        in_flight[tenant] = in_flight.get(tenant, 0) + 1
+
+    # Starvation guard, bounded to one request per tenant per batch
+    if starvation_seconds:
+        starving = [
+            (tenant, queue[0]) for tenant, queue in queues.items()
+            if (now - queue[0]["Created"]).total_seconds() >= starvation_seconds
+        ]
+        for tenant, row in sorted(starving, key=lambda item: item[1]["Created"]):
+            if len(selected) >= capacity:
+                break
+            if has_room(tenant):
+                take(tenant, row)
+
+    # Weighted fair queueing over the rest
+    positions = {tenant: 0 for tenant in queues}
+    heap = []
+
+    def push_next(tenant):
+        queue = queues[tenant]
+        while positions[tenant] < len(queue) and queue[positions[tenant]]["Id"] in taken:
+            positions[tenant] += 1
+        if positions[tenant] < len(queue) and has_room(tenant):
+            row = queue[positions[tenant]]
+            finish = (in_flight.get(tenant, 0) + 1) / weights.get(tenant, 1.0)
+            heapq.heappush(heap, (finish, row["Created"], row["Id"], tenant))
+
+    for tenant in queues:
+        push_next(tenant)
+    while heap and len(selected) < capacity:
+        _, _, _, tenant = heapq.heappop(heap)
+        take(tenant, queues[tenant][positions[tenant]])
+        positions[tenant] += 1
+        push_next(tenant)
+
+    return selected
+
+def dispatch_queued_requests(capacity=None):
+    """
+    Pick a fair batch of queued requests, submit it and mark the requests as processing.
+
+    Args:
+        capacity (int, optional): Maximum number of requests to dispatch, default BATCH_MAX_REQUESTS
+
+    Returns:
+        dict: Mapping of batch id to the ids of the requests it covers
+    """
+    from openai_requests import create_jsonl_and_upload, BatchUploadError
+
+    capacity = capacity or config.get_int("BATCH_MAX_REQUESTS", 1000)
+    # Claims left behind by a dispatcher that died before submitting go back to the queue. A dispatcher
+    # that died after submitting but before marking its rows processing causes them to be sent again.
+    claim_timeout = config.get_float("DISPATCH_CLAIM_TIMEOUT_SECONDS", 900)
+    requeued = release_claimed_requests(claimed_before=datetime.now() - timedelta(seconds=claim_timeout))
+    if requeued:
+        logger.warning(f"Requeued {requeued} requests whose dispatch claim expired")
+
+    in_flight = {}
+    for stat in get_tenant_queue_stats():
+        if stat["Status"] in IN_FLIGHT_STATUSES:
+            in_flight[stat["TenantId"]] = in_flight.get(stat["TenantId"], 0) + stat["Count"]
+    # No tenant can contribute more than a full batch, so there is no need to read further into its queue
+    queued_rows = get_queued_requests(per_tenant_limit=capacity)
+    selected = select_fair_batch(
+        queued_rows,
+        capacity,
+        in_flight=in_flight,
+        weights=parse_tenant_weights(config.get_setting("TENANT_WEIGHTS")),
+        max_in_flight=config.get_int("TENANT_MAX_IN_FLIGHT", 0) or None,
+        starvation_seconds=config.get_float("TENANT_STARVATION_SECONDS", 3600)
+    )
+
+    # Another dispatcher may have claimed some of the same rows since they were read; skip those
+    claimed = set(claim_queued_requests([row["Id"] for row in selected]))
+    selected = [row for row in selected if row["Id"] in claimed]
+    if not selected:
+        return {}
+
+    try:
+        batches = create_jsonl_and_upload(selected)
+    except Exception as e:
+        # Batches uploaded before the failure are already submitted: mark their requests processing and
+        # return only the rest to the queue
+        submitted = e.batches if isinstance(e, BatchUploadError) else {}
+        for batch_id, ids in submitted.items():
+            update_requests_to_processing(ids, batch_id)
+        submitted_ids = {id for ids in submitted.values() for id in ids}
+        release_claimed_requests(ids=[row["Id"] for row in selected if row["Id"] not in submitted_ids])
+        raise
+    for batch_id, ids in batches.items():
+        update_requests_to_processing(ids, batch_id)
+
+    per_tenant = {}
+    for row in selected:
+        tenant = row.get("TenantId") or DEFAULT_TENANT
+        per_tenant[tenant] = per_tenant.get(tenant, 0) + 1
+    logger.info(f"Dispatched {len(selected)} requests in {len(batches)} batches: {per_tenant}")
+    return batches
+
+def render_queue_metrics(now=None):
+    """
+    Render the per-tenant queue backlog in the Prometheus text exposition format.
+
+    Args:
+        now (datetime, optional): Current time, for tests
+
+    Returns:
+        str: Metrics text
+    """
+    now = now or datetime.now()
+    lines = [
+        "# HELP batch_queue_requests Requests queued, dispatching or processing in the batch queue, per tenant",
+        "# TYPE batch_queue_requests gauge",
+    ]
+    ages = [
+        "# HELP batch_queue_oldest_age_seconds Age of the oldest request per tenant and status",
+        "# TYPE batch_queue_oldest_age_seconds gauge",
+    ]
+    for stat in get_tenant_queue_stats():
+        tenant = str(stat["TenantId"]).replace("\\", "\\\\").replace('"', '\\"')
+        labels = f'tenant="{tenant}",status="{stat["Status"]}"'
+        lines.append(f"batch_queue_requests{{{labels}}} {stat['Count']}")
+        if stat["Oldest"]:
+            ages.append(f"batch_queue_oldest_age_seconds{{{labels}}} {(now - stat['Oldest']).total_seconds():.0f}")
+    return "\n".join(lines + ages) + "\n"
@@ -0,0 +1,134 @@
+# Registry of response JSON schemas. Schemas are stored once in SQL under the SHA-256 of their
+# canonical JSON, and parsed and compiled into validators at most once per process.
+import json
+import hashlib
+import logging
+from functools import lru_cache
+from db import insert_response_schema, get_response_schema
+
+logger = logging.getLogger(__name__)
+
+class SchemaNotFoundError(KeyError):
+    """Raised when a schema id is not registered"""
+
+class CompiledSchema:
+    """
+    A parsed structured-output schema with its compiled validator.
+
+    Attributes:
+        id (str): SHA-256 of the canonical schema JSON
+        schema (dict): The schema as sent to the model (either a json_schema wrapper or a bare schema)
+        text (str): Canonical JSON text of the schema
+    """
+    def __init__(self, schema):
+        from jsonschema.validators import validator_for
+
+        self.schema = schema
+        self.text = canonical_json(schema)
+        self.id = hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+
+        # Structured outputs wrap the JSON schema as {"name": ..., "strict": ..., "schema": {...}}
+        inner = schema.get("schema") if isinstance(schema.get("schema"), dict) else schema
+        validator_class = validator_for(inner)
+        validator_class.check_schema(inner)
+        self._validator = validator_class(inner)
+
+    def validate(self, instance):
+        """
+        Validate a model output against the schema.
+
+        Args:
+            instance: Parsed model output
+
+        Returns:
+            list: Validation error messages, empty when the output is valid
+        """
+        return [
+            f"{'/'.join(str(p) for p in error.absolute_path) or '<root>'}: {error.message}"
+            for error in self._validator.iter_errors(instance)
+        ]
+
+def canonical_json(schema):
+    return json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+@lru_cache(maxsize=256)
+def compile_schema_text(schema_text):
+    """
+    Parse and compile a schema sent inline as a string. Identical strings hit the cache and skip json.loads.
+
+    Args:
+        schema_text (str): JSON schema text
+
+    Returns:
+        CompiledSchema: The compiled schema
+
+    Raises:
+        ValueError: If the text is not valid JSON or not a valid JSON schema
+    """
+    from jsonschema.exceptions import SchemaError
+
+    try:
+        schema = json.loads(schema_text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON schema: {str(e)}")
+    if not isinstance(schema, dict):
+        raise ValueError("Invalid JSON schema: expected a JSON object")
+    try:
+        return CompiledSchema(schema)
+    except SchemaError as e:
+        raise ValueError(f"Invalid JSON schema: {e.message}")
+
+@lru_cache(maxsize=1024)
+def get_schema(schema_id):
+    """
+    Get a registered schema by id, loading and compiling it on first use in this process.
+
+    Args:
+        schema_id (str): Id returned by register_schema
+
+    Returns:
+        CompiledSchema: The compiled schema
+
+    Raises:
+        SchemaNotFoundError: If no schema with this id is registered
+    """
+    schema_text = get_response_schema(schema_id)
+    if schema_text is None:
+        raise SchemaNotFoundError(schema_id)
+    return compile_schema_text(schema_text)
+
+def register_schema(schema_text):
+    """
+    Register a schema, storing it once. Registering the same schema again returns the same id.
+
+    Args:
+        schema_text (str): JSON schema text
+
+    Returns:
+        CompiledSchema: The compiled, registered schema
+    """
+    compiled = compile_schema_text(schema_text)
+    insert_response_schema(compiled.id, compiled.text)
+    logger.info(f"Registered response schema {compiled.id}")
+    return compiled
+
+def resolve_schema(schema_text=None, schema_id=None):
+    """
+    Resolve the schema of a request, given either inline text or a registered id.
+
+    Args:
+        schema_text (str, optional): Inline JSON schema text
+        schema_id (str, optional): Id of a registered schema
+
+    Returns:
+        CompiledSchema: The compiled schema
+
+    Raises:
+        ValueError: If neither or both are given, or the inline schema is invalid
+        SchemaNotFoundError: If schema_id is not registered
+    """
+    if bool(schema_text) == bool(schema_id):
+        raise ValueError("Provide exactly one of schema or schema_id")
+    if schema_id:
+        return get_schema(schema_id)
+    return compile_schema_text(schema_text)
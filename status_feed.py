@@ -0,0 +1,185 @@
+# In-memory change feed of request statuses, used to answer status polls and long-polls
+# without a database query per poll. Changes made in this process are published by db.py
+# status listeners; changes made elsewhere (the batch collector, other workers) are picked up
+# by a single periodic refresh of the ids somebody is long-polling, and otherwise by re-reading
+# any snapshot older than STATUS_FEED_TTL_SECONDS.
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import config
+from db import add_status_listener, get_request_statuses
+
+logger = logging.getLogger(__name__)
+
+def compute_etag(status, batch_id):
+    digest = hashlib.sha1(f"{status}|{batch_id or ''}".encode("utf-8")).hexdigest()[:16]
+    return f'"{digest}"'
+
+class ChangeFeed:
+    """
+    Latest known status of recently seen requests, with async waiters woken on change.
+    Safe to publish from any thread; waiters live on the event loop.
+    """
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # id -> snapshot, least recently used first
+        self._waiters = {}  # id -> list of (loop, future)
+        self._lock = threading.Lock()
+
+    def get(self, id, max_age=None):
+        """
+        Get the snapshot of a request.
+
+        Args:
+            id (str): Request id
+            max_age (float, optional): Ignore snapshots last confirmed more than this many seconds ago
+
+        Returns:
+            dict: Snapshot, or None if unknown (or too old)
+        """
+        with self._lock:
+            snapshot = self._entries.get(id)
+            if snapshot is None:
+                return None
+            if max_age is not None and time.monotonic() - snapshot["checked"] > max_age:
+                return None
+            self._entries.move_to_end(id)
+            return snapshot
+
+    def publish(self, id, status, batch_id=None):
+        """
+        Record the status of a request and wake anyone waiting for it to change.
+
+        Args:
+            id (str): Request id
+            status (str): New status
+            batch_id (str, optional): Batch id of the request
+
+        Returns:
+            dict: The stored snapshot
+        """
+        snapshot = {
+            "request_id": id, "status": status, "batch_id": batch_id,
+            "etag": compute_etag(status, batch_id), "checked": time.monotonic()
+        }
+        with self._lock:
+            previous = self._entries.get(id)
+            if previous is not None and previous["etag"] == snapshot["etag"]:
+                # Unchanged, but now known to be current
+                previous["checked"] = snapshot["checked"]
+                self._entries.move_to_end(id)
+                return previous
+            self._entries[id] = snapshot
+            self._entries.move_to_end(id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            waiters = self._waiters.pop(id, [])
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future, snapshot)
+        return snapshot
+
+    def watched_ids(self):
+        with self._lock:
+            return list(self._waiters)
+
+    async def wait_for_change(self, id, etag, timeout):
+        """
+        Wait until the status of a request no longer matches etag, or until the timeout.
+
+        Args:
+            id (str): Request id
+            etag (str): ETag the caller already has
+            timeout (float): Maximum number of seconds to wait
+
+        Returns:
+            dict: The latest snapshot (unchanged if the wait timed out)
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            snapshot = self._entries.get(id)
+            if snapshot is not None and snapshot["etag"] != etag:
+                return snapshot
+            self._waiters.setdefault(id, []).append((loop, future))
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return self.get(id)
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(id)
+                if waiters and (loop, future) in waiters:
+                    waiters.remove((loop, future))
+                    if not waiters:
+                        del self._waiters[id]
+
+def _resolve(future, snapshot):
+    if not future.done():
+        future.set_result(snapshot)
+
+feed = ChangeFeed(max_entries=config.get_int("STATUS_FEED_MAX_ENTRIES", 100000))
+
+def _on_status_changes(changes):
+    for change in changes:
+        feed.publish(change["Id"], change["Status"], change["BatchId"])
+
+add_status_listener(_on_status_changes)
+
+def get_fresh(id):
+    """
+    Get the status of a request from the feed if it was confirmed within STATUS_FEED_TTL_SECONDS.
+
+    Args:
+        id (str): Request id
+
+    Returns:
+        dict: Snapshot, or None if it has to be read from the database
+    """
+    return feed.get(id, max_age=config.get_float("STATUS_FEED_TTL_SECONDS", 2.0))
+
+def load_status(id):
+    """
+    Get the status of a request from the feed, reading it from the database when the feed has no
+    snapshot confirmed within STATUS_FEED_TTL_SECONDS. Status changes are mostly written by other
+    processes, so a cached snapshot cannot be trusted for longer than that.
+
+    Args:
+        id (str): Request id
+
+    Returns:
+        dict: Snapshot, or None if the request does not exist
+    """
+    snapshot = get_fresh(id)
+    if snapshot is None:
+        row = get_request_statuses([id]).get(id)
+        if row is not None:
+            snapshot = feed.publish(id, row["Status"], row["BatchId"])
+    return snapshot
+
+async def refresh_watched(interval=None):
+    """
+    Periodically re-read the status of requests that have long-pollers waiting, in one query per
+    interval, so changes written by other processes reach the feed. Runs until cancelled.
+    Keep STATUS_FEED_REFRESH_SECONDS at or below STATUS_FEED_TTL_SECONDS, so watched snapshots
+    stay fresh and their polls never need their own query.
+
+    Args:
+        interval (float, optional): Seconds between refreshes, default STATUS_FEED_REFRESH_SECONDS
+    """
+    interval = interval or config.get_float("STATUS_FEED_REFRESH_SECONDS", 2.0)
+    while True:
+        await asyncio.sleep(interval)
+        ids = feed.watched_ids()
+        if not ids:
+            continue
+        try:
+            statuses = await asyncio.to_thread(get_request_statuses, ids)
+            for id, row in statuses.items():
+                feed.publish(id, row["Status"], row["BatchId"])
+        except Exception as e:
+            logger.warning(f"Error refreshing request statuses: {str(e)}")
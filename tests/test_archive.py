@@ -0,0 +1,95 @@
+import re
+from datetime import datetime
+import pytest
+import db
+
+class FakeCursor:
+    """Records statements; answers each with the rows `respond` returns for it"""
+    def __init__(self, respond):
+        self.respond = respond
+        self.statements = []
+        self.results = []
+
+    def execute(self, sql, params=()):
+        self.statements.append((sql, list(params)))
+        self.results = list(self.respond(sql, list(params)))
+
+    def fetchone(self):
+        return self.results[0][0]
+
+    def fetchall(self):
+        return self.results.pop(0) if self.results else []
+
+    def nextset(self):
+        self.results.pop(0)
+        return bool(self.results)
+
+    def close(self):
+        pass
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.committed = False
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.committed = True
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def connect(monkeypatch):
+    def install(respond):
+        cursor = FakeCursor(respond)
+        conn = FakeConnection(cursor)
+        monkeypatch.setattr(db, "get_sql_connection", lambda: conn)
+        return cursor, conn
+    return install
+
+def statements(sql):
+    return [statement.strip() for statement in sql.split(";") if statement.strip()]
+
+def test_archive_statement_shape(connect):
+    cursor, conn = connect(lambda sql, params: [[(2,)], [("https://blob/a",)]])
+    archived, urls = db.archive_finished_requests(datetime(2026, 1, 1), 500)
+    assert (archived, urls) == (2, ["https://blob/a"])
+    assert conn.committed
+
+    sql, params = cursor.statements[0]
+    assert params == [500, datetime(2026, 1, 1)]
+    parts = statements(sql)
+    assert "SET XACT_ABORT ON" in parts
+    assert parts.index("BEGIN TRANSACTION") < parts.index("COMMIT TRANSACTION")
+
+    # SQL Server allows one OUTPUT ... INTO per DML statement
+    for part in parts:
+        if re.match(r"(DELETE|INSERT|UPDATE)\b", part):
+            assert len(re.findall(r"\bOUTPUT\b", part)) <= 1, part
+
+    columns = ", ".join(db.ARCHIVE_COLUMNS)
+    delete = next(part for part in parts if part.startswith("DELETE TOP (?) FROM BatchRequest"))
+    assert f"INTO @archived ({columns})" in delete
+    assert "CallbackPending = 0" in delete
+    insert = next(part for part in parts if part.startswith("INSERT INTO BatchRequestArchive"))
+    assert insert.endswith("FROM @archived")
+    blob_delete = next(part for part in parts if part.startswith("DELETE FROM BatchRequestBlob"))
+    assert "SELECT Id FROM @archived" in blob_delete
+    declare = next(part for part in parts if part.startswith("DECLARE @archived TABLE"))
+    for column in db.ARCHIVE_COLUMNS:
+        assert re.search(rf"\b{column} ", declare), column
+
+def test_request_statuses_fall_back_to_archive(connect):
+    def respond(sql, params):
+        table = "BatchRequestArchive" if "FROM BatchRequestArchive" in sql else "BatchRequest"
+        rows = {"BatchRequest": {"live": ("live", "processing", "b1")}, "BatchRequestArchive": {"old": ("old", "completed", "b0")}}
+        return [[rows[table][id] for id in params if id in rows[table]]]
+
+    cursor, _ = connect(respond)
+    statuses = db.get_request_statuses(["live", "old", "unknown"])
+    assert statuses == {"live": {"Status": "processing", "BatchId": "b1"}, "old": {"Status": "completed", "BatchId": "b0"}}
+    # Only the ids missing from BatchRequest are looked up in the archive
+    assert cursor.statements[1][1] == ["old", "unknown"]
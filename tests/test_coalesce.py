@@ -0,0 +1,42 @@
+import io
+import hashlib
+from coalesce import HashingReader, hash_file, compute_fingerprint, coalesce_requests
+
+def test_fingerprint_is_stable():
+    assert compute_fingerprint(["h1", "h2"], "extract", "s", "gpt") == compute_fingerprint(["h1", "h2"], "extract", "s", "gpt")
+
+def test_fingerprint_covers_every_part():
+    base = compute_fingerprint(["h1", "h2"], "extract", "s", "gpt")
+    assert compute_fingerprint(["h2", "h1"], "extract", "s", "gpt") != base
+    assert compute_fingerprint(["h1", "h2"], "extract names", "s", "gpt") != base
+    assert compute_fingerprint(["h1", "h2"], "extract", "t", "gpt") != base
+    assert compute_fingerprint(["h1", "h2"], "extract", "s", "gpt-mini") != base
+
+def test_fingerprint_parts_cannot_run_into_each_other():
+    assert compute_fingerprint(["ab"], "c", None, "d") != compute_fingerprint(["b"], "ca", None, "d")
+    assert compute_fingerprint(["a", "b"], "i", None, "d") != compute_fingerprint(["ab"], "i", None, "d")
+
+def test_hashing_reader_and_hash_file_match_sha256(tmp_path):
+    content = b"document content" * 1000
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(content)
+
+    reader = HashingReader(io.BytesIO(content))
+    while reader.read(333):
+        pass
+
+    expected = hashlib.sha256(content).hexdigest()
+    assert reader.hexdigest() == expected
+    assert hash_file(str(path), chunk_size=100) == expected
+
+def test_coalesce_requests_groups_by_fingerprint_in_first_seen_order():
+    rows = [
+        {"Id": "1", "Fingerprint": "f1"},
+        {"Id": "2", "Fingerprint": "f2"},
+        {"Id": "3", "Fingerprint": "f1"},
+        {"Id": "4", "Fingerprint": None},
+    ]
+    groups = coalesce_requests(rows)
+    assert list(groups) == ["f1", "f2", "4"]
+    assert [row["Id"] for row in groups["f1"]] == ["1", "3"]
+    assert [row["Id"] for row in groups["4"]] == ["4"]
@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+import pytest
+import pypdf
+import documentIntelligence
+
+def fake_result(page_indexes, tables):
+    """
+    Analyze result for a range of document pages. Each page's text names the page and the range it
+    came from; tables are lists of 0-based document page indexes.
+    """
+    content = ""
+    pages = []
+    for local_number, index in enumerate(page_indexes, start=1):
+        text = f"p{index}@r{page_indexes[0]}"
+        pages.append(SimpleNamespace(page_number=local_number, spans=[SimpleNamespace(offset=len(content), length=len(text))]))
+        content += text
+    local = {index: number for number, index in enumerate(page_indexes, start=1)}
+    result_tables = [
+        SimpleNamespace(bounding_regions=[SimpleNamespace(page_number=local[index]) for index in table if index in local])
+        for table in tables
+    ]
+    return SimpleNamespace(content=content, pages=pages, tables=[t for t in result_tables if t.bounding_regions])
+
+@pytest.fixture
+def analyze(monkeypatch):
+    """Run analyze_in_page_ranges on a fake document with the given tables, returning (page, range start) pairs"""
+    def run(page_count, pages_per_range, tables=()):
+        monkeypatch.setattr(pypdf, "PdfReader", lambda stream: None)
+        monkeypatch.setattr(documentIntelligence, "pdf_subset", lambda reader, indexes: list(indexes))
+        monkeypatch.setattr(documentIntelligence, "analyze_document", lambda part: fake_result(part, tables))
+        texts = documentIntelligence.analyze_in_page_ranges(b"%PDF", page_count, pages_per_range, max_parallel=2)
+        return [tuple(int(n) for n in text[1:].split("@r")) for text in texts]
+    return run
+
+def test_every_page_once_in_order(analyze):
+    stitched = analyze(10, 4)
+    assert [page for page, _ in stitched] == list(range(10))
+
+def test_boundary_page_comes_from_the_later_range(analyze):
+    # Ranges: pages 0-4, 4-8, 8-9; page 4 and page 8 are shared
+    stitched = dict(analyze(10, 4))
+    assert stitched[4] == 4
+    assert stitched[8] == 8
+
+def test_table_ending_on_boundary_page_stays_in_earlier_range(analyze):
+    stitched = dict(analyze(10, 4, tables=[[3, 4]]))
+    assert sorted(stitched) == list(range(10))
+    assert stitched[3] == stitched[4] == 0
+
+def test_table_starting_on_boundary_page_stays_in_later_range(analyze):
+    stitched = dict(analyze(10, 4, tables=[[4, 5]]))
+    assert sorted(stitched) == list(range(10))
+    assert stitched[4] == stitched[5] == 4
+
+def test_table_running_past_boundary_on_both_sides_is_split(analyze):
+    # Documented limitation: pages 3-5 around the boundary on page 4 come from two calls
+    stitched = dict(analyze(10, 4, tables=[[3, 4, 5]]))
+    assert sorted(stitched) == list(range(10))
+    assert stitched[3] == stitched[4] == 0
+    assert stitched[5] == 4
+
+def test_single_page_last_range(analyze):
+    stitched = analyze(9, 4)
+    assert [page for page, _ in stitched] == list(range(9))
+
+def test_unreadable_pdf_is_analyzed_unsplit(monkeypatch):
+    monkeypatch.setenv("DOCUMENT_INTELLIGENCE_SPLIT_PAGES", "4")
+    assert documentIntelligence.count_pdf_pages(b"%PDF-1.7 truncated") is None
+    assert documentIntelligence._split_page_count(b"%PDF-1.7 truncated") is None
@@ -0,0 +1,118 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import pytest
+import requests
+import openai_requests
+import scheduler
+from openai_requests import BatchUploadError
+from scheduler import select_fair_batch, parse_tenant_weights
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+def make_rows(tenant, count, age_seconds):
+    """count rows of one tenant, the oldest age_seconds old, one second apart"""
+    return [
+        {"Id": f"{tenant}{i}", "TenantId": tenant, "Created": NOW - timedelta(seconds=age_seconds - i)}
+        for i in range(count)
+    ]
+
+def queue(*tenant_rows):
+    return sorted((row for rows in tenant_rows for row in rows), key=lambda row: row["Created"])
+
+def tenants(rows):
+    return Counter(row["TenantId"] for row in rows)
+
+def test_equal_weights_alternate_between_tenants():
+    rows = queue(make_rows("a", 50, 100), make_rows("b", 5, 10))
+    selected = select_fair_batch(rows, 6, now=NOW)
+    assert [row["Id"] for row in selected] == ["a0", "b0", "a1", "b1", "a2", "b2"]
+
+def test_each_tenant_keeps_its_own_order():
+    rows = queue(make_rows("a", 20, 100), make_rows("b", 20, 50))
+    selected = select_fair_batch(rows, 20, now=NOW)
+    for tenant in ("a", "b"):
+        ids = [row["Id"] for row in selected if row["TenantId"] == tenant]
+        assert ids == [f"{tenant}{i}" for i in range(len(ids))]
+
+def test_weights_set_the_share():
+    rows = queue(make_rows("a", 50, 100), make_rows("b", 50, 100))
+    selected = select_fair_batch(rows, 8, weights={"a": 3}, now=NOW)
+    assert tenants(selected) == {"a": 6, "b": 2}
+
+def test_work_in_flight_counts_against_the_share():
+    rows = queue(make_rows("a", 50, 100), make_rows("b", 50, 100))
+    selected = select_fair_batch(rows, 6, in_flight={"a": 4}, now=NOW)
+    assert tenants(selected) == {"a": 1, "b": 5}
+
+def test_max_in_flight_caps_a_tenant():
+    rows = queue(make_rows("a", 50, 100), make_rows("b", 2, 10))
+    selected = select_fair_batch(rows, 10, in_flight={"a": 4}, max_in_flight=6, now=NOW)
+    assert tenants(selected) == {"a": 2, "b": 2}
+
+def test_capacity_and_no_duplicates():
+    rows = queue(make_rows("a", 30, 100), make_rows("b", 30, 100), make_rows("c", 30, 100))
+    selected = select_fair_batch(rows, 25, starvation_seconds=50, now=NOW)
+    assert len(selected) == 25
+    assert len({row["Id"] for row in selected}) == 25
+
+def test_fewer_rows_than_capacity_takes_all():
+    rows = queue(make_rows("a", 3, 100), make_rows("b", 2, 10))
+    assert len(select_fair_batch(rows, 100, now=NOW)) == 5
+
+def test_starvation_guard_takes_one_row_per_starving_tenant():
+    # All of a's backlog is past the threshold; b's rows are fresh
+    rows = queue(make_rows("a", 200, 100), make_rows("b", 10, 10))
+    selected = select_fair_batch(rows, 6, starvation_seconds=50, now=NOW)
+    assert selected[0]["Id"] == "a0"
+    assert tenants(selected) == {"a": 3, "b": 3}
+
+def test_starvation_guard_orders_starving_tenants_oldest_first():
+    rows = queue(make_rows("a", 5, 100), make_rows("b", 5, 300), make_rows("c", 5, 10))
+    selected = select_fair_batch(rows, 3, starvation_seconds=50, now=NOW)
+    assert [row["Id"] for row in selected[:2]] == ["b0", "a0"]
+    assert selected[2]["TenantId"] == "c"
+
+def test_starvation_guard_respects_max_in_flight():
+    rows = queue(make_rows("a", 5, 100), make_rows("b", 5, 10))
+    selected = select_fair_batch(rows, 4, in_flight={"a": 3}, max_in_flight=3, starvation_seconds=50, now=NOW)
+    assert tenants(selected) == {"b": 3}
+
+def test_parse_tenant_weights():
+    assert parse_tenant_weights("a=3, b=0.5,ignored") == {"a": 3.0, "b": 0.5}
+    assert parse_tenant_weights(None) == {}
+    assert parse_tenant_weights("a=0") == {"a": 0.01}
+
+def queued_request(id, deployment):
+    return {"Id": id, "TenantId": "t", "Created": NOW, "ModelDeploymentName": deployment, "Fingerprint": None,
+            "Instructions": "extract", "ResponseJsonSchema": "{}", "FileNames": f"{id}.pdf"}
+
+def test_upload_failure_carries_the_batches_already_submitted(monkeypatch):
+    def post(url, headers, data):
+        if "/deployments/b/" in url:
+            return SimpleNamespace(status_code=500, text="unavailable")
+        return SimpleNamespace(status_code=201, json=lambda: {"id": "batch-a"})
+    monkeypatch.setattr(requests, "post", post)
+
+    with pytest.raises(BatchUploadError) as error:
+        openai_requests.create_jsonl_and_upload([queued_request("1", "a"), queued_request("2", "b"), queued_request("3", "a")])
+    assert error.value.batches == {"batch-a": ["1", "3"]}
+
+def test_dispatch_releases_only_requests_not_submitted(monkeypatch):
+    rows = [queued_request("1", "a"), queued_request("2", "b"), queued_request("3", "a")]
+    processing = {}
+    released = []
+    monkeypatch.setattr(scheduler, "release_claimed_requests", lambda ids=None, claimed_before=None: released.extend(ids or []) and 0)
+    monkeypatch.setattr(scheduler, "get_tenant_queue_stats", lambda: [])
+    monkeypatch.setattr(scheduler, "get_queued_requests", lambda per_tenant_limit=None: rows)
+    monkeypatch.setattr(scheduler, "claim_queued_requests", lambda ids: ids)
+    monkeypatch.setattr(scheduler, "update_requests_to_processing", lambda ids, batch_id: processing.update({batch_id: ids}))
+
+    def upload(selected):
+        raise BatchUploadError("Failed to upload batch: 500", {"batch-a": ["1", "3"]})
+    monkeypatch.setattr(openai_requests, "create_jsonl_and_upload", upload)
+
+    with pytest.raises(BatchUploadError):
+        scheduler.dispatch_queued_requests(capacity=10)
+    assert processing == {"batch-a": ["1", "3"]}
+    assert released == ["2"]
@@ -0,0 +1,148 @@
+# Routing stage in front of Document Intelligence. Born-digital PDFs often carry a clean text layer;
+# their pages are extracted locally in a process pool and only scanned or low-quality pages are
+# sent to Document Intelligence.
+import io
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import config
+from documentIntelligence import document_content_to_text, analyze_document_pages, pdf_subset
+
+logger = logging.getLogger(__name__)
+
+_process_pool = None
+# Requests arrive on several threads; without the lock two could each start a pool
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn: forking a process that already runs threads (uvicorn, SDK pools) is unsafe
+            _process_pool = ProcessPoolExecutor(
+                max_workers=config.get_int("TEXT_LAYER_WORKERS", os.cpu_count() or 2),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+def shutdown_process_pool():
+    """Stop the worker processes, if they were started. Extractions not yet started are cancelled."""
+    global _process_pool
+    with _process_pool_lock:
+        pool, _process_pool = _process_pool, None
+    if pool:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def extract_page_texts(document_content):
+    """
+    Extract the text layer of every page of a PDF. Runs in a worker process.
+
+    Args:
+        document_content (bytes): The PDF
+
+    Returns:
+        list: Text of each page, in page order ("" for pages without a text layer)
+    """
+    from pypdf import PdfReader
+
+    reader = PdfReader(io.BytesIO(document_content))
+    texts = []
+    for page in reader.pages:
+        try:
+            texts.append(page.extract_text() or "")
+        except Exception:
+            texts.append("")
+    return texts
+
+def is_good_text(text, min_chars=None):
+    """
+    Decide whether the extracted text of one page can be used as is. Pages without text are scans;
+    pages with unmapped glyphs or replacement characters have a broken font encoding. Only a low
+    floor of characters is required, so short but clean pages (covers, signature pages) still count;
+    the amount and kind of text are judged over the whole document by is_good_document.
+
+    Args:
+        text (str): Extracted text of one page
+        min_chars (int, optional): Minimum non-whitespace characters, default TEXT_LAYER_MIN_PAGE_CHARS
+
+    Returns:
+        bool: True if the page's text layer can be used
+    """
+    if min_chars is None:
+        min_chars = config.get_int("TEXT_LAYER_MIN_PAGE_CHARS", 10)
+    visible = [c for c in text if not c.isspace()]
+    if not visible or len(visible) < min_chars or "(cid:" in text:
+        return False
+    bad = sum(1 for c in visible if c == "�" or not c.isprintable())
+    return bad / len(visible) < 0.01
+
+def is_good_document(page_texts):
+    """
+    Decide whether the usable pages of a document, taken together, look like real text: at least
+    TEXT_LAYER_MIN_CHARS visible characters, mostly alphanumeric (TEXT_LAYER_MIN_ALNUM_RATIO).
+    Judging this over the document rather than per page keeps short pages from failing it.
+
+    Args:
+        page_texts (list): Text of the pages that passed is_good_text
+
+    Returns:
+        bool: True if those pages can skip Document Intelligence
+    """
+    visible = [c for text in page_texts for c in text if not c.isspace()]
+    if len(visible) < config.get_int("TEXT_LAYER_MIN_CHARS", 200):
+        return False
+    alphanumeric = sum(1 for c in visible if c.isalnum())
+    return alphanumeric / len(visible) >= config.get_float("TEXT_LAYER_MIN_ALNUM_RATIO", 0.6)
+
+def route_document(file_name, document_content):
+    """
+    Convert a document to text, using its text layer where it is good and Document Intelligence elsewhere.
+    Blocks until extraction and analysis are done; call it from a worker thread, not the event loop.
+
+    Args:
+        file_name (str): Name of the document, for the report
+        document_content (bytes): The document
+
+    Returns:
+        tuple: (text, report) where report has file, path ("text_layer", "document_intelligence"
+               or "mixed"), pages, text_layer_pages and duration_ms
+    """
+    start = time.perf_counter()
+    report = {"file": file_name, "path": "document_intelligence", "pages": None, "text_layer_pages": 0}
+
+    page_texts = None
+    if document_content.startswith(b"%PDF"):
+        try:
+            page_texts = _get_process_pool().submit(extract_page_texts, document_content).result()
+        except Exception as e:
+            logger.warning(f"Text layer extraction failed for {file_name}: {str(e)}")
+
+    if not page_texts:
+        text = document_content_to_text(document_content)
+    else:
+        good = [is_good_text(page_text) for page_text in page_texts]
+        if not is_good_document([page_text for page_text, is_good in zip(page_texts, good) if is_good]):
+            good = [False] * len(page_texts)
+        report["pages"] = len(page_texts)
+        report["text_layer_pages"] = sum(good)
+        if all(good):
+            report["path"] = "text_layer"
+            text = "\n".join(page_texts)
+        elif not any(good):
+            text = document_content_to_text(document_content)
+        else:
+            # Only the pages without a usable text layer go to Document Intelligence, in one call
+            from pypdf import PdfReader
+
+            report["path"] = "mixed"
+            bad_pages = [index for index, is_good in enumerate(good) if not is_good]
+            subset = pdf_subset(PdfReader(io.BytesIO(document_content)), bad_pages)
+            analyzed = iter(analyze_document_pages(subset))
+            text = "\n".join(page_text if is_good else next(analyzed, "") for page_text, is_good in zip(page_texts, good))
+
+    report["duration_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    logger.info(f"Routed {file_name}: {report}")
+    return text, report
@@ -0,0 +1,262 @@
+# Webhook callbacks for queued requests. When a request with a CallbackUrl reaches a final status, db.py
+# marks its callback pending and its status and result are POSTed to that URL by a bounded worker pool.
+# Every attempt is recorded on the row, and a sweeper retries callbacks that failed or were left behind
+# by a process that stopped, so a restart does not lose them. Processes that finish requests or sweep
+# callbacks call start_webhooks() at startup and stop_webhooks() before they exit.
+import hmac
+import json
+import socket
+import hashlib
+import logging
+import ipaddress
+import threading
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import config
+from db import add_status_listener, claim_pending_callbacks, record_callback_attempt, FINAL_STATUSES
+
+logger = logging.getLogger(__name__)
+
+def _host_matches(host, allowed_host):
+    return host == allowed_host or host.endswith("." + allowed_host)
+
+def check_callback_url(url, resolve=False):
+    """
+    Check that the server may POST to a callback URL. It must be http(s) and, unless its host is in
+    WEBHOOK_ALLOWED_HOSTS, point at a public address: loopback, private, link-local (cloud metadata)
+    and reserved addresses are refused. When WEBHOOK_ALLOWED_HOSTS is set, only those hosts and
+    their subdomains are accepted.
+
+    Args:
+        url (str): Callback URL
+        resolve (bool): Also resolve host names and check every address they resolve to
+
+    Raises:
+        ValueError: If the URL may not be called
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("callback_url must be an http(s) URL")
+    host = parsed.hostname.lower().rstrip(".")
+
+    allowed_hosts = [h.strip().lower() for h in config.get_setting("WEBHOOK_ALLOWED_HOSTS", "").split(",") if h.strip()]
+    if allowed_hosts:
+        if not any(_host_matches(host, allowed_host) for allowed_host in allowed_hosts):
+            raise ValueError(f"callback_url host {host} is not allowed")
+        # Allowed hosts are trusted explicitly, even when they are internal
+        return
+
+    if _host_matches(host, "localhost"):
+        raise ValueError("callback_url must not point at a local address")
+    try:
+        addresses = [ipaddress.ip_address(host)]
+    except ValueError:
+        if not resolve:
+            return
+        try:
+            infos = socket.getaddrinfo(host, parsed.port or (443 if parsed.scheme == "https" else 80), proto=socket.IPPROTO_TCP)
+        except socket.gaierror:
+            raise ValueError(f"callback_url host {host} does not resolve")
+        addresses = [ipaddress.ip_address(info[4][0].split("%")[0]) for info in infos]
+
+    for address in addresses:
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise ValueError("callback_url must not point at a private, local or reserved address")
+
+class WebhookDispatcher:
+    """
+    Delivers webhook calls on at most `concurrency` threads. A failed delivery is recorded with the time
+    of its next attempt, exponential backoff from backoff_seconds, and the sweeper sends it again then;
+    waiting between attempts holds neither a worker thread nor state that a restart would lose.
+    """
+    def __init__(self, concurrency=8, max_attempts=5, backoff_seconds=2.0, timeout_seconds=10.0, secret=None):
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.timeout_seconds = timeout_seconds
+        self.secret = secret.encode() if secret else None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="webhook")
+        self._session = None
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        return self._session
+
+    def submit(self, callback):
+        """
+        Queue a delivery.
+
+        Args:
+            callback (dict): Id, Status, BatchId, Result, CallbackUrl and CallbackAttempts of a request
+        """
+        future = self._executor.submit(self._deliver, callback)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._discard)
+
+    def _discard(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def shutdown(self, cancel_queued=True):
+        """
+        Stop taking deliveries and wait for the ones in progress. Unless cancel_queued is False, queued
+        deliveries that have not started are dropped here and stay pending in the database for the next sweep.
+        """
+        dropped = 0
+        if cancel_queued:
+            with self._lock:
+                futures = list(self._futures)
+            # Outside the lock: cancelling runs _discard, which takes it
+            dropped = sum(1 for future in futures if future.cancel())
+        self._executor.shutdown(wait=True)
+        if dropped:
+            logger.warning(f"{dropped} webhook callbacks not sent before shutdown; they stay pending for the next sweep")
+
+    def _deliver(self, callback):
+        try:
+            done, error = self._post(callback)
+        except Exception as e:
+            done, error = False, str(e)
+
+        request_id = callback["Id"]
+        attempt = callback["CallbackAttempts"] + 1
+        if not done and attempt >= self.max_attempts:
+            logger.error(f"Webhook for request {request_id} failed after {attempt} attempts: {error}")
+            done = True
+        next_attempt = None
+        if not done:
+            delay = self.backoff_seconds * (2 ** (attempt - 1))
+            next_attempt = datetime.now() + timedelta(seconds=delay)
+            logger.warning(f"Webhook for request {request_id} failed ({error}), retrying in {delay}s or at the next sweep after that")
+        try:
+            record_callback_attempt(request_id, done, next_attempt)
+        except Exception as e:
+            # The row keeps its lease, so the sweeper tries again once it expires
+            logger.error(f"Error recording webhook attempt for request {request_id}: {str(e)}")
+
+    def _post(self, callback):
+        """Make one delivery attempt. Returns (done, error): done when no further attempt should be made."""
+        url = callback["CallbackUrl"]
+        try:
+            # Checked again at delivery, against what the host resolves to now
+            check_callback_url(url, resolve=True)
+        except ValueError as e:
+            logger.error(f"Webhook for request {callback['Id']} not sent to {url}: {str(e)}")
+            return True, None
+
+        result = callback["Result"]
+        if result:
+            try:
+                result = json.loads(result)
+            except (TypeError, json.JSONDecodeError):
+                pass
+        body = json.dumps({
+            "request_id": callback["Id"],
+            "status": callback["Status"],
+            "batch_id": callback["BatchId"],
+            "result": result
+        }).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            # Lets receivers check the call came from us: HMAC-SHA256 of the body with WEBHOOK_SECRET
+            headers["X-Signature-SHA256"] = hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+
+        # Redirects are not followed: they could lead to an address check_callback_url refuses
+        response = self._get_session().post(url, data=body, headers=headers, timeout=self.timeout_seconds, allow_redirects=False)
+        if response.status_code < 300:
+            return True, None
+        # Client errors other than throttling will not succeed on retry
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            logger.error(f"Webhook for request {callback['Id']} rejected by {url}: {response.status_code}")
+            return True, None
+        return False, f"HTTP {response.status_code}"
+
+_dispatcher = None
+_sweep_stop = None
+_registered = False
+
+def _on_status_changes(changes):
+    dispatcher = _dispatcher
+    if dispatcher is None:
+        # Stopped: the callbacks stay pending and the next sweep sends them
+        return
+    for change in changes:
+        if change["CallbackUrl"] and change["Status"] in FINAL_STATUSES:
+            dispatcher.submit(dict(change, CallbackAttempts=0))
+
+def _create_dispatcher():
+    return WebhookDispatcher(
+        concurrency=config.get_int("WEBHOOK_CONCURRENCY", 8),
+        max_attempts=config.get_int("WEBHOOK_MAX_ATTEMPTS", 5),
+        backoff_seconds=config.get_float("WEBHOOK_BACKOFF_SECONDS", 2.0),
+        timeout_seconds=config.get_float("WEBHOOK_TIMEOUT_SECONDS", 10.0),
+        secret=config.get_setting("WEBHOOK_SECRET")
+    )
+
+def sweep_pending_callbacks(dispatcher, limit=100):
+    """
+    Send pending callbacks that are due: retries, and callbacks left behind by a process that stopped.
+
+    Args:
+        dispatcher (WebhookDispatcher): Dispatcher to deliver them
+        limit (int): Maximum number of callbacks to claim
+
+    Returns:
+        int: Number of callbacks submitted
+    """
+    # The lease must outlast a delivery, or a slow one could be sent again by another sweeper
+    lease_seconds = config.get_float("WEBHOOK_LEASE_SECONDS", 300)
+    callbacks = claim_pending_callbacks(limit, lease_seconds)
+    for callback in callbacks:
+        dispatcher.submit(callback)
+    return len(callbacks)
+
+def _sweep_loop(stop_event):
+    interval = config.get_float("WEBHOOK_SWEEP_SECONDS", 30)
+    while not stop_event.wait(interval):
+        dispatcher = _dispatcher
+        if dispatcher is None:
+            break
+        try:
+            sweep_pending_callbacks(dispatcher)
+        except Exception as e:
+            logger.error(f"Error sweeping webhook callbacks: {str(e)}")
+
+def start_webhooks():
+    """
+    Start sending webhook callbacks from this process: register the status listener that sends them as
+    soon as requests finish and, unless WEBHOOK_SWEEP_SECONDS is 0, start the sweeper thread.
+    """
+    global _dispatcher, _sweep_stop, _registered
+    if _dispatcher is not None:
+        return
+    _dispatcher = _create_dispatcher()
+    if not _registered:
+        add_status_listener(_on_status_changes)
+        _registered = True
+    if config.get_float("WEBHOOK_SWEEP_SECONDS", 30) > 0:
+        _sweep_stop = threading.Event()
+        threading.Thread(target=_sweep_loop, args=(_sweep_stop,), name="webhook-sweep", daemon=True).start()
+
+def stop_webhooks():
+    """Stop the sweeper and wait for deliveries in progress. Callbacks not yet sent stay pending."""
+    global _dispatcher, _sweep_stop
+    dispatcher, _dispatcher = _dispatcher, None
+    if _sweep_stop:
+        _sweep_stop.set()
+        _sweep_stop = None
+    if dispatcher:
+        dispatcher.shutdown()
+
+if __name__ == "__main__":
+    # Sweep once, e.g. from a scheduled job when no API process runs the sweeper
+    dispatcher = _create_dispatcher()
+    print(sweep_pending_callbacks(dispatcher))
+    dispatcher.shutdown(cancel_queued=False)